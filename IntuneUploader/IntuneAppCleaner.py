@@ -36,11 +36,18 @@ class IntuneAppCleaner(IntuneUploaderBase):
             "description": "If True, will only print what would have been done.",
             "default": False,
         },
+        "max_runtime_seconds": {
+            "required": False,
+            "description": "The number of seconds the processor may run. Retries and polling draw from this budget and the processor fails once it is spent. Defaults to no limit.",
+        },
     }
     output_variables = {
         "intuneappcleaner_summary_result": {
             "description": "Description of interesting results."
-        }
+        },
+        "intuneappcleaner_metrics": {
+            "description": "The wall-clock and CPU seconds of each phase and the number of Graph requests of the run."
+        },
     }
 
     def main(self):
@@ -58,16 +65,28 @@ class IntuneAppCleaner(IntuneUploaderBase):
         test_mode = self.env.get("test_mode")
 
         # Get access token
-        self.token = self.obtain_accesstoken(
-            self.CLIENT_ID, self.CLIENT_SECRET, self.TENANT_ID
-        )
+        with self.phase("auth"):
+            self.token = self.obtain_accesstoken(
+                self.CLIENT_ID, self.CLIENT_SECRET, self.TENANT_ID
+            )
 
         # When running from the command line, keep_versions is a string, convert to int
         if isinstance(keep_versions, str):
             keep_versions = int(keep_versions)
 
-        # Get macthing apps
-        apps = self.get_matching_apps(app_name)
+        # Get macthing apps from the local app inventory
+        with self.phase("lookup"):
+            apps = self.get_matching_apps(
+                app_name,
+                fields=["id", "displayName", "primaryBundleVersion", "buildNumber"],
+            )
+            # Apps are deleted based on them, so confirm them with Intune first
+            if len(apps) > keep_versions and not test_mode:
+                apps = self.get_matching_apps(
+                    app_name,
+                    refresh=True,
+                    fields=["id", "displayName", "primaryBundleVersion", "buildNumber"],
+                )
         self.output(f"Found {str(len(apps))} apps matching {app_name}")
 
         if len(apps) == 0:
@@ -98,10 +117,22 @@ class IntuneAppCleaner(IntuneUploaderBase):
                     + " "
                     + app["primaryBundleVersion"]
                 )
-                # Only delete if not in test mode
-                if not test_mode:
-                    self.makeapirequestDelete(
-                        self.BASE_ENDPOINT + "/" + app["id"], self.token
+            # Only delete if not in test mode
+            if not test_mode:
+                with self.phase("delete"):
+                    self.graph_batch(
+                        [
+                            {
+                                "method": "DELETE",
+                                "url": self.BASE_ENDPOINT + "/" + app["id"],
+                            }
+                            for app in apps_to_delete
+                        ],
+                        # Apps deleted elsewhere in the meantime are already gone
+                        status_codes=[200, 204, 404],
+                    )
+                    self.remove_from_app_inventory(
+                        [app["id"] for app in apps_to_delete]
                     )
 
         self.env["intuneappcleaner_summary_result"] = {
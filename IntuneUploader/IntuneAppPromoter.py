@@ -44,11 +44,18 @@ class IntuneAppPromoter(IntuneUploaderBase):
             "required": True,
             "description": "An array of dicts containing information about the assignments and schedule.",
         },
+        "max_runtime_seconds": {
+            "required": False,
+            "description": "The number of seconds the processor may run. Retries and polling draw from this budget and the processor fails once it is spent. Defaults to no limit.",
+        },
     }
     output_variables = {
         "intuneapppromoter_summary_result": {
             "description": "Description of interesting results."
-        }
+        },
+        "intuneapppromoter_metrics": {
+            "description": "The wall-clock and CPU seconds of each phase and the number of Graph requests of the run."
+        },
     }
 
     def main(self):
@@ -65,11 +72,24 @@ class IntuneAppPromoter(IntuneUploaderBase):
         promotion_info = self.env.get("promotion_info")
 
         def promote_app(group):
+            # The app is from the local app inventory, confirm it was not promoted
+            # elsewhere since it was synced
+            if self.get_app_inventory_ttl():
+                with self.phase("lookup"):
+                    current_app = self.get_apps(
+                        f"{self.BASE_ENDPOINT}/{intune_app.get('id')}", fields=["notes"]
+                    )[0]
+                if current_app.get("notes") != intune_app.get("notes"):
+                    self.output(
+                        f"{intune_app.get('displayName')} {app_version} changed in Intune since it was looked up, skipping."
+                    )
+                    return
             notes = {
                 "promotion_date": date.strftime("%Y-%m-%d"),
                 "ring": group.get("ring"),
             }
-            self.assign_app(app, [group])
+            with self.phase("assignment"):
+                self.assign_app(app, [group])
             notes["ring"] = group.get("ring")
             data = json.dumps(
                 {
@@ -77,19 +97,22 @@ class IntuneAppPromoter(IntuneUploaderBase):
                     "@odata.type": intune_app.get("@odata.type"),
                 }
             )
-            self.makeapirequestPatch(
-                f"{self.BASE_ENDPOINT}/{intune_app.get('id')}",
-                self.token,
-                None,
-                data,
-                204,
-            )
+            with self.phase("promotion"):
+                self.makeapirequestPatch(
+                    f"{self.BASE_ENDPOINT}/{intune_app.get('id')}",
+                    self.token,
+                    None,
+                    data,
+                    204,
+                )
+            self.update_app_inventory(intune_app.get("id"))
             promotions.append({"version": app_version, "ring": group.get("ring")})
 
         # Get access token
-        self.token = self.obtain_accesstoken(
-            self.CLIENT_ID, self.CLIENT_SECRET, self.TENANT_ID
-        )
+        with self.phase("auth"):
+            self.token = self.obtain_accesstoken(
+                self.CLIENT_ID, self.CLIENT_SECRET, self.TENANT_ID
+            )
 
         # Check if promotion info is set
         if not promotion_info:
@@ -98,8 +121,18 @@ class IntuneAppPromoter(IntuneUploaderBase):
 
         promotions = []
 
-        # Get matching apps
-        intune_apps = self.get_matching_apps(app_name)
+        # Get matching apps from the local app inventory
+        with self.phase("lookup"):
+            intune_apps = self.get_matching_apps(
+                app_name,
+                fields=[
+                    "id",
+                    "displayName",
+                    "primaryBundleVersion",
+                    "buildNumber",
+                    "notes",
+                ],
+            )
         # If no apps are found, exit
         if not intune_apps:
             self.output(f"No app found with name: {app_name}, exiting.")
@@ -120,18 +153,25 @@ class IntuneAppPromoter(IntuneUploaderBase):
             # If no match, return False
             return False
 
-        for intune_app in intune_apps:
+        # Get assignments for all matching apps in batches
+        with self.phase("lookup"):
+            app_assignments = self.graph_batch(
+                [
+                    {
+                        "method": "GET",
+                        "url": f"{self.BASE_ENDPOINT}/{intune_app.get('id')}/assignments",
+                    }
+                    for intune_app in intune_apps
+                ],
+                status_codes=[200],
+            )
+
+        for intune_app, assignments in zip(intune_apps, app_assignments, strict=True):
             self.request = intune_app
 
-            # Get assignments for app
-            assignments = self.makeapirequest(
-                f"{self.BASE_ENDPOINT}/{intune_app.get('id')}/assignments",
-                self.token,
-                None,
-            )
             current_group_ids = [
                 c["target"].get("groupId")
-                for c in assignments["value"]
+                for c in assignments["body"]["value"]
                 if c["target"].get("groupId")
             ]
 
@@ -10,10 +10,13 @@ It is heavily inspired by the IntuneImporter processor by @SteveKueng.
 Created by Tobias Almén
 """
 
+import copy
 import json
 import os
 import sys
 import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
 
 from autopkglib import ProcessorError
@@ -128,7 +131,7 @@ class IntuneAppUploader(IntuneUploaderBase):
         },
         "assignment_info": {
             "required": False,
-            "description": "The assignment info of the app. Provided as an array of dicts containing keys 'group_id' and 'intent'. See https://github.com/almenscorner/intune-uploader/wiki/IntuneAppUploader#input-variables for more information.",
+            "description": "The assignment info of the app. Provided as an array of dicts containing keys 'group_id' and 'intent'. Only used for the tenant set by TENANT_ID. See https://github.com/almenscorner/intune-uploader/wiki/IntuneAppUploader#input-variables for more information.",
         },
         "lob_app": {
             "required": False,
@@ -137,7 +140,25 @@ class IntuneAppUploader(IntuneUploaderBase):
         },
         "scope_tags": {
             "required": False,
-            "description": "The scope tags to assign to the app. Provide as a list of strings the ids of the scope tags.",
+            "description": "The scope tags to assign to the app. Provide as a list of strings the ids of the scope tags. Only used for the tenant set by TENANT_ID.",
+        },
+        "upload_concurrency": {
+            "required": False,
+            "description": "The number of blocks to upload to Azure Storage at the same time.",
+            "default": 4,
+        },
+        "tenants": {
+            "required": False,
+            "description": "An array of dicts containing the keys 'CLIENT_ID', 'CLIENT_SECRET' and 'TENANT_ID' of each tenant to upload the app to, and optionally 'assignment_info' and 'scope_tags' for the tenant. Group and scope tag IDs differ between tenants, so other tenants than the one set by TENANT_ID are only assigned and scoped with their own keys. The app is encrypted once and uploaded to all tenants concurrently. Defaults to the tenant set by CLIENT_ID, CLIENT_SECRET and TENANT_ID.",
+        },
+        "pipelined_upload": {
+            "required": False,
+            "description": "Whether to upload each encrypted chunk while the next is encrypted instead of writing the encrypted app to a temp file first. Interrupted pipelined uploads can not be resumed. Only used when uploading to a single tenant.",
+            "default": False,
+        },
+        "max_runtime_seconds": {
+            "required": False,
+            "description": "The number of seconds the processor may run. Retries, polling and block uploads draw from this budget. Once it is spent the upload stops, a new app without content is deleted and an interrupted upload is resumed by the next run. Defaults to no limit.",
         },
     }
     output_variables = {
@@ -157,6 +178,9 @@ class IntuneAppUploader(IntuneUploaderBase):
         "intuneappuploader_summary_result": {
             "description": "Description of interesting results.",
         },
+        "intuneappuploader_metrics": {
+            "description": "The wall-clock and CPU seconds of each phase, the seconds spent in each upload state, the bytes read, encrypted and uploaded and the number of Graph requests of the run.",
+        },
     }
 
     def main(self):
@@ -199,11 +223,19 @@ class IntuneAppUploader(IntuneUploaderBase):
         ignore_current_app = self.env.get("ignore_current_app")
         ignore_current_version = self.env.get("ignore_current_version")
         lob_app = self.env.get("lob_app")
+        upload_concurrency = self.env.get("upload_concurrency")
+        pipelined_upload = self.env.get("pipelined_upload")
+        tenants = self.env.get("tenants") or [
+            {
+                "CLIENT_ID": self.CLIENT_ID,
+                "CLIENT_SECRET": self.CLIENT_SECRET,
+                "TENANT_ID": self.TENANT_ID,
+            }
+        ]
 
-        # Get the access token
-        self.token = self.obtain_accesstoken(
-            self.CLIENT_ID, self.CLIENT_SECRET, self.TENANT_ID
-        )
+        # When running from the command line, upload_concurrency is a string, convert to int
+        if isinstance(upload_concurrency, str):
+            upload_concurrency = int(upload_concurrency)
 
         @dataclass
         class App:
@@ -285,218 +317,465 @@ class IntuneAppUploader(IntuneUploaderBase):
                 "value": self.encode_icon(app_icon),
             }
 
-        if app_scope_tags:
-            app_data.roleScopeTagIds = app_scope_tags
+        # Encrypt the app at most once per run, the encryption info is only metadata
+        # sent when the file is committed so the same encrypted file serves every tenant
+        shared_encryption = {}
+        shared_encryption_lock = threading.Lock()
+
+        def _encrypt_app_once(cancelled: threading.Event):
+            with shared_encryption_lock:
+                if not shared_encryption:
+                    new_file, tempfilename = tempfile.mkstemp(dir=self.RECIPE_CACHE_DIR)
+                    os.close(new_file)
+                    # Track the file before encrypting so it is removed if encryption fails
+                    self.encrypted_files_in_use.add(tempfilename)
+                    encryption_info = self.encrypt_app_to_file(
+                        tempfilename, cancelled=cancelled
+                    )
+                    shared_encryption["encrypted_file"] = tempfilename
+                    shared_encryption["encryption_info"] = encryption_info
+            return (
+                shared_encryption["encrypted_file"],
+                shared_encryption["encryption_info"],
+            )
 
-        # Get the app data as a dictionary
-        app_data_dict = app_data.__dict__
-        # Convert the dictionary to JSON
-        data = json.dumps(app_data_dict)
-        # Check if app already exists
-        current_app_result, current_app_data = self.get_current_app(
-            app_displayname, app_bundleVersion, app_data_dict["@odata.type"]
-        )
-        # Get app categories from Intune
-        intune_app_categories = self.get_app_categories()
-
-        # Check if the app categories exist in Intune
-        if app_categories:
-            categories_to_create = []
-            for category in app_categories:
-                if category not in intune_app_categories:
-                    categories_to_create.append(category)
-            if categories_to_create:
-                self.output(
-                    f"Creating categories {', '.join(categories_to_create)} in Intune"
-                )
-                self.create_app_categories(categories_to_create)
+        def upload_to_tenant(self, tenant: dict) -> dict:
+            """Uploads the app to a tenant.
 
-        # If the ignore_current_app variable is set to true, create the app regardless of whether it already exists
-        if ignore_current_app and not current_app_data:
-            raise ProcessorError(
-                "App not found in Intune. Please set ignore_current_app to false."
-            )
-        if (
-            ignore_current_app
-            and app_bundleVersion != current_app_data["primaryBundleVersion"]
-        ):
-            self.output(
-                f"Creating app {app_data.displayName} version {app_bundleVersion}"
+            Args:
+                tenant (dict): The CLIENT_ID, CLIENT_SECRET and TENANT_ID of the tenant,
+                    and optionally its assignment_info and scope_tags.
+
+            Returns:
+                dict: The result of the upload.
+            """
+            # Group and scope tag IDs are per tenant, the inputs only apply to the
+            # tenant set by TENANT_ID
+            is_primary_tenant = tenant["TENANT_ID"] == self.TENANT_ID
+            tenant_assignment_info = tenant.get(
+                "assignment_info", app_assignment_info if is_primary_tenant else None
             )
-            # Create the app
-            self.request = self.makeapirequestPost(
-                f"{self.BASE_ENDPOINT}", self.token, "", data, 201
+            tenant_scope_tags = tenant.get(
+                "scope_tags", app_scope_tags if is_primary_tenant else None
             )
+            if not is_primary_tenant and (
+                (app_assignment_info and "assignment_info" not in tenant)
+                or (app_scope_tags and "scope_tags" not in tenant)
+            ):
+                self.output(
+                    f"Not using assignment_info and scope_tags for tenant {tenant['TENANT_ID']}, set them in its tenants entry instead"
+                )
+            self.CLIENT_ID = tenant["CLIENT_ID"]
+            self.CLIENT_SECRET = tenant["CLIENT_SECRET"]
+            self.TENANT_ID = tenant["TENANT_ID"]
+
+            # Get the app data as a dictionary, the scope tags differ per tenant
+            app_data_dict = dict(app_data.__dict__)
+            if tenant_scope_tags:
+                app_data_dict["roleScopeTagIds"] = tenant_scope_tags
+            # Convert the dictionary to JSON
+            data = json.dumps(app_data_dict)
+            # Get the access token
+            with self.phase("auth"):
+                self.token = self.obtain_accesstoken(
+                    self.CLIENT_ID, self.CLIENT_SECRET, self.TENANT_ID
+                )
+            lookup = {}
 
-        # If the ignore_current_app variable is not set to true, check if the app already exists and update it if necessary
-        else:
-            # If the app needs to be updated or the current version should be ignored
-            if current_app_result == "update" or ignore_current_version is True:
-                # If the app is not found, raise an error
-                if not current_app_data:
-                    raise ProcessorError(
-                        "App not found in Intune. Please set ignore_current_version to false."
-                    )
-
-                # If the app version is the same, update the file contents
-                if current_app_data["primaryBundleVersion"] == app_bundleVersion:
-                    self.output(
-                        f'Upadating File Contents for app {current_app_data["displayName"]} version {current_app_data["primaryBundleVersion"]}'
-                    )
-                # If the app version is different, update the app
-                else:
+            def lookup_app():
+                # Check if app already exists
+                lookup["result"], lookup["data"] = self.get_current_app(
+                    app_displayname, app_bundleVersion, app_data_dict["@odata.type"]
+                )
+                # Check if an interrupted upload of this app can be resumed
+                lookup["upload_state"] = self.resume_upload(lookup["data"])
+
+            def create_categories():
+                # Get app categories from Intune
+                intune_app_categories = self.get_category_catalog(app_categories)
+
+                # Check if the app categories exist in Intune
+                categories_to_create = []
+                for category in app_categories:
+                    if category not in intune_app_categories:
+                        categories_to_create.append(category)
+                if categories_to_create:
                     self.output(
-                        f'Updating app {current_app_data["displayName"]} from {current_app_data["primaryBundleVersion"]} to version {app_bundleVersion}'
+                        f"Creating categories {', '.join(categories_to_create)} in Intune"
                     )
-                # Update the app
-                self.content_update = True
-                self.makeapirequestPatch(
-                    f'{self.BASE_ENDPOINT}/{current_app_data["id"]}',
-                    self.token,
-                    "",
-                    data,
-                    204,
-                )
-                self.request = current_app_data
-
-            # If the app is up to date and the current version should not be ignored
-            if current_app_result == "current" and ignore_current_version is False:
+                    self.create_app_categories(categories_to_create)
+
+            # Look up the app while the categories are created
+            phases = {"lookup": (lookup_app, [])}
+            if app_categories:
+                phases["create_categories"] = (create_categories, [])
+            _, overlap_saved = self.run_phases(phases)
+            current_app_result = lookup["result"]
+            current_app_data = lookup["data"]
+            upload_state = lookup["upload_state"]
+
+            if upload_state:
                 self.output(
-                    f'App {current_app_data["displayName"]} version {current_app_data["primaryBundleVersion"]} is up to date'
+                    f'Resuming interrupted upload for app {current_app_data["displayName"]} version {app_bundleVersion}'
                 )
-                return
-
-            # If the app does not exist
-            if current_app_result is None:
+            # If the ignore_current_app variable is set to true, create the app regardless of whether it already exists
+            elif ignore_current_app and not current_app_data:
+                raise ProcessorError(
+                    "App not found in Intune. Please set ignore_current_app to false."
+                )
+            elif (
+                ignore_current_app
+                and app_bundleVersion != current_app_data["primaryBundleVersion"]
+            ):
                 self.output(
-                    f"Creating app {app_data.displayName} version {app_data.primaryBundleVersion}"
+                    f"Creating app {app_data.displayName} version {app_bundleVersion}"
                 )
                 # Create the app
                 self.request = self.makeapirequestPost(
                     f"{self.BASE_ENDPOINT}", self.token, "", data, 201
                 )
+                self.record_app_icon(app_data_dict, self.request["id"])
+
+            # If the ignore_current_app variable is not set to true, check if the app already exists and update it if necessary
+            else:
+                # If the app needs to be updated or the current version should be ignored
+                if current_app_result == "update" or ignore_current_version is True:
+                    # If the app is not found, raise an error
+                    if not current_app_data:
+                        raise ProcessorError(
+                            "App not found in Intune. Please set ignore_current_version to false."
+                        )
+
+                    # If the app version is the same, update the file contents
+                    if current_app_data["primaryBundleVersion"] == app_bundleVersion:
+                        self.output(
+                            f'Upadating File Contents for app {current_app_data["displayName"]} version {current_app_data["primaryBundleVersion"]}'
+                        )
+                    # If the app version is different, update the app
+                    else:
+                        self.output(
+                            f'Updating app {current_app_data["displayName"]} from {current_app_data["primaryBundleVersion"]} to version {app_bundleVersion}'
+                        )
+                    # Update the app with only the fields that changed
+                    self.content_update = True
+                    changes = self.get_app_changes(
+                        app_data_dict, current_app_data["id"]
+                    )
+                    if len(changes) > 1:
+                        self.makeapirequestPatch(
+                            f'{self.BASE_ENDPOINT}/{current_app_data["id"]}',
+                            self.token,
+                            "",
+                            json.dumps(changes),
+                            204,
+                        )
+                        self.record_app_icon(changes, current_app_data["id"])
+                    else:
+                        self.output("App metadata is unchanged, skipping update")
+                    self.request = current_app_data
+
+                # If the app is up to date and the current version should not be ignored
+                if current_app_result == "current" and ignore_current_version is False:
+                    self.output(
+                        f'App {current_app_data["displayName"]} version {current_app_data["primaryBundleVersion"]} is up to date'
+                    )
+                    return {
+                        "tenant_id": self.TENANT_ID,
+                        "name": app_displayname,
+                        "version": app_bundleVersion,
+                        "intune_app_id": current_app_data["id"],
+                        "result": "current",
+                    }
+
+                # If the app does not exist
+                if current_app_result is None:
+                    self.output(
+                        f"Creating app {app_data.displayName} version {app_data.primaryBundleVersion}"
+                    )
+                    # Create the app
+                    self.request = self.makeapirequestPost(
+                        f"{self.BASE_ENDPOINT}", self.token, "", data, 201
+                    )
+                    self.record_app_icon(app_data_dict, self.request["id"])
 
-        # Create the content version
-        content_version_url = f'{self.BASE_ENDPOINT}/{self.request["id"]}/{str(app_data_dict["@odata.type"]).replace("#", "")}/contentVersions'
-        self.content_version_request = self.makeapirequestPost(
-            content_version_url,
-            self.token,
-            "",
-            json.dumps({}),
-            201,
-        )
-
-        if not self.content_version_request:
-            self.output("Failed to create content version, trying again")
-            self.content_version_request = self.makeapirequestPost(
-                content_version_url,
-                self.token,
-                "",
-                json.dumps({}),
-                201,
+            # Skip the upload if the app already holds this exact app file
+            content_version_id = (
+                None
+                if upload_state
+                else self.get_uploaded_content_version(self.request)
             )
-            if not self.content_version_request:
-                self.delete_app()
-                raise ProcessorError("Failed to create content version")
-
-        # Encrypt the app
-        encryptionData, encryptionInfo = self.encrypt_app()
-
-        # Write the encryption data to a file
-        new_file, tempfilename = tempfile.mkstemp(dir=self.RECIPE_CACHE_DIR)
-        with open(new_file, "wb") as f:
-            f.write(encryptionData)
-
-        # Get the app file info
-        content_file = self.appFile(tempfilename)
-        # Post the app file info
-        data = json.dumps(content_file)
-        self.content_file_request = self.makeapirequestPost(
-            f'{self.BASE_ENDPOINT}/{self.request["id"]}/microsoft.graph.macOSLobApp/contentVersions/{self.content_version_request["id"]}/files',
-            self.token,
-            "",
-            data,
-            201,
-        )
+            if content_version_id:
+                self.output(
+                    f"App file is already the content of app {self.request['displayName']}, skipping upload"
+                )
+                self.content_version_request = {"id": content_version_id}
 
-        # Get the content file upload URL
-        file_content_request_url = f'{self.BASE_ENDPOINT}/{self.request["id"]}/microsoft.graph.macOSLobApp/contentVersions/{self.content_version_request["id"]}/files/{self.content_file_request["id"]}'
-        file_content_request = self.makeapirequest(
-            file_content_request_url,
-            self.token,
-        )
+            upload = {"state": upload_state}
 
-        self.wait_for_azure_storage_uri()
+            def stage_content():
+                # Create the content version
+                content_version_url = f'{self.BASE_ENDPOINT}/{self.request["id"]}/{str(app_data_dict["@odata.type"]).replace("#", "")}/contentVersions'
+                self.content_version_request = self.makeapirequestPost(
+                    content_version_url,
+                    self.token,
+                    "",
+                    json.dumps({}),
+                    201,
+                )
 
-        if not file_content_request["azureStorageUri"]:
-            # try again
-            file_content_request = self.makeapirequest(
-                file_content_request_url,
-                self.token,
-            )
+                if not self.content_version_request:
+                    self.output("Failed to create content version, trying again")
+                    self.content_version_request = self.makeapirequestPost(
+                        content_version_url,
+                        self.token,
+                        "",
+                        json.dumps({}),
+                        201,
+                    )
+                    if not self.content_version_request:
+                        self.delete_app()
+                        raise ProcessorError("Failed to create content version")
+
+                # Get the app file info
+                content_file = self.appFile()
+                # Post the app file info
+                data = json.dumps(content_file)
+                self.content_file_request = self.makeapirequestPost(
+                    f'{self.BASE_ENDPOINT}/{self.request["id"]}/microsoft.graph.macOSLobApp/contentVersions/{self.content_version_request["id"]}/files',
+                    self.token,
+                    "",
+                    data,
+                    201,
+                )
 
-            if not file_content_request["azureStorageUri"]:
-                self.delete_app()
-                raise ProcessorError("Failed to get the Azure Storage upload URL")
+            def wait_for_upload_url():
+                # Wait for the content file upload URL
+                file_content_request = self.wait_for_azure_storage_uri()
+
+                if not file_content_request["azureStorageUri"]:
+                    # try again
+                    file_content_request = self.get_file_content_status()
+
+                    if not file_content_request["azureStorageUri"]:
+                        self.delete_app()
+                        raise ProcessorError(
+                            "Failed to get the Azure Storage upload URL"
+                        )
+                upload["azure_storage_uri"] = file_content_request["azureStorageUri"]
+
+            def encrypt_app():
+                # Encrypt the app once, it is shared by all tenants
+                (
+                    upload["encrypted_file"],
+                    upload["encryption_info"],
+                ) = _encrypt_app_once(self.phases_failed)
+
+            def upload_app():
+                if pipelined_upload and len(tenants) == 1:
+                    # Encrypt and upload the app in one pass, there is no temp file to resume from
+                    upload["state"] = {
+                        "encryption_info": self.upload_encrypted_app(
+                            upload["azure_storage_uri"], upload_concurrency
+                        ),
+                        "blocks_committed": True,
+                    }
+                elif not upload["state"]:
+                    # Record the upload state so an interrupted upload can be resumed
+                    upload["state"] = {
+                        "app_id": self.request["id"],
+                        "content_version_id": self.content_version_request["id"],
+                        "content_file_id": self.content_file_request["id"],
+                        "content_update": self.content_update,
+                        "azure_storage_uri": upload["azure_storage_uri"],
+                        "encryption_info": upload["encryption_info"],
+                        "encrypted_file": upload["encrypted_file"],
+                        "app_file": self.app_file,
+                        "app_file_size": os.path.getsize(self.app_file),
+                        "app_file_mtime": os.path.getmtime(self.app_file),
+                        "blocks": [],
+                        "blocks_committed": False,
+                    }
+                    self.save_upload_state(upload["state"])
+
+                # Create the block list
+                if not upload["state"]["blocks_committed"]:
+                    self.create_blocklist(
+                        upload["state"]["encrypted_file"],
+                        upload["state"]["azure_storage_uri"],
+                        upload_concurrency,
+                        upload["state"],
+                    )
+                    upload["state"]["blocks_committed"] = True
+                    self.save_upload_state(upload["state"])
 
-        # Create the block list
-        self.create_blocklist(tempfilename, file_content_request["azureStorageUri"])
+            def commit_app():
+                # Commit the file
+                data = json.dumps(
+                    {"fileEncryptionInfo": upload["state"]["encryption_info"]}
+                )
+                self.makeapirequestPost(
+                    f'{self.BASE_ENDPOINT}/{self.request["id"]}/microsoft.graph.macOSLobApp/contentVersions/{self.content_version_request["id"]}/files/{self.content_file_request["id"]}/commit',
+                    self.token,
+                    "",
+                    data,
+                    200,
+                )
 
-        # Clean up temp file
-        os.unlink(tempfilename)
+                # Clean up temp file and upload state
+                self.discard_upload_state(upload["state"])
 
-        # Commit the file
-        data = json.dumps({"fileEncryptionInfo": encryptionInfo})
-        self.makeapirequestPost(
-            f'{self.BASE_ENDPOINT}/{self.request["id"]}/microsoft.graph.macOSLobApp/contentVersions/{self.content_version_request["id"]}/files/{self.content_file_request["id"]}/commit',
-            self.token,
-            "",
-            data,
-            200,
-        )
+                # Wait for the file to upload
+                self.wait_for_file_upload()
 
-        # Wait for the file to upload
-        self.wait_for_file_upload()
-
-        # Patch the app to use the new content version
-        data = {
-            "@odata.type": "#microsoft.graph.macOSLobApp",
-            "committedContentVersion": self.content_version_request["id"],
-        }
-
-        self.makeapirequestPatch(
-            f"{self.BASE_ENDPOINT}/{self.request['id']}",
-            self.token,
-            "",
-            json.dumps(data),
-            204,
-        )
+                # Patch the app to use the new content version
+                data = {
+                    "@odata.type": "#microsoft.graph.macOSLobApp",
+                    "committedContentVersion": self.content_version_request["id"],
+                }
+
+                self.makeapirequestPatch(
+                    f"{self.BASE_ENDPOINT}/{self.request['id']}",
+                    self.token,
+                    "",
+                    json.dumps(data),
+                    204,
+                )
+
+                # The app file was hashed while it was encrypted
+                self.record_upload(
+                    self.get_encryption_info_sha256(upload["state"]["encryption_info"])
+                )
 
-        if app_categories:
-            self.update_categories(app_categories, self.request.get("categories"))
-
-        if app_assignment_info:
-            for assignment in app_assignment_info:
-                if "exclude" not in assignment:
-                    assignment["exclude"] = False
-            self.assign_app(app_data, app_assignment_info)
-
-        self.env["intune_app_changed"] = True
-        self.env["intuneappuploader_summary_result"] = {
-            "summary_text": "The following new items were imported into Intune:",
-            "report_fields": [
-                "name",
-                "version",
-                "intune_app_id",
-                "content_version_id",
-            ],
-            "data": {
+            def assign_app():
+                assignment_info = copy.deepcopy(tenant_assignment_info)
+                for assignment in assignment_info:
+                    if "exclude" not in assignment:
+                        assignment["exclude"] = False
+                self.assign_app(app_data, assignment_info)
+
+            # Encrypt while the content file is staged. New content has to be committed
+            # before the categories and assignments of the app are updated
+            phases = {}
+            if not content_version_id:
+                if upload_state:
+                    phases["block_upload"] = (upload_app, [])
+                else:
+                    phases["staging"] = (stage_content, [])
+                    phases["sas_wait"] = (wait_for_upload_url, ["staging"])
+                    if pipelined_upload and len(tenants) == 1:
+                        phases["block_upload"] = (upload_app, ["sas_wait"])
+                    else:
+                        phases["encrypt"] = (encrypt_app, [])
+                        phases["block_upload"] = (upload_app, ["sas_wait", "encrypt"])
+                phases["commit_wait"] = (commit_app, ["block_upload"])
+            app_dependencies = ["commit_wait"] if "commit_wait" in phases else []
+            if app_categories:
+                phases["categories"] = (
+                    lambda: self.update_categories(
+                        app_categories, self.request.get("categories")
+                    ),
+                    app_dependencies,
+                )
+            if tenant_assignment_info:
+                phases["assignment"] = (assign_app, app_dependencies)
+            try:
+                _, saved = self.run_phases(phases)
+            except ProcessorError:
+                # Stop cleanly once the runtime budget is spent, an upload with a
+                # recorded state is resumed by the next run instead
+                if self.deadline_exceeded() and not upload["state"]:
+                    self.delete_app()
+                raise
+            overlap_saved += saved
+            self.output(
+                f"Running phases concurrently saved {overlap_saved:.1f} seconds",
+                verbose_level=2,
+            )
+
+            self.update_app_inventory(self.request["id"])
+
+            return {
+                "tenant_id": self.TENANT_ID,
                 "name": app_displayname,
                 "version": app_bundleVersion,
                 "intune_app_id": self.request["id"],
                 "content_version_id": self.content_version_request["id"],
-            },
-        }
+                "content_upload": "skipped, app file already in Intune"
+                if content_version_id
+                else "uploaded",
+                "overlap_saved": round(overlap_saved, 1),
+                "result": "imported",
+            }
+
+        self.encrypted_files_in_use = set()
+        try:
+            if len(tenants) == 1:
+                results = [upload_to_tenant(self, tenants[0])]
+            else:
+                # Each tenant gets its own copy of the processor so their state does not mix
+                self.output(f"Uploading app to {len(tenants)} tenants")
+                results = []
+                with ThreadPoolExecutor(max_workers=len(tenants)) as executor:
+                    futures = [
+                        executor.submit(upload_to_tenant, copy.copy(self), tenant)
+                        for tenant in tenants
+                    ]
+                    for tenant, future in zip(tenants, futures, strict=True):
+                        try:
+                            results.append(future.result())
+                        except (ProcessorError, OSError, KeyError, ValueError) as e:
+                            self.output(
+                                f"Failed to upload app to tenant {tenant['TENANT_ID']}: {e}"
+                            )
+                            results.append(
+                                {
+                                    "tenant_id": tenant["TENANT_ID"],
+                                    "name": app_displayname,
+                                    "version": app_bundleVersion,
+                                    "result": f"failed: {e}",
+                                }
+                            )
+        finally:
+            # Remove the shared encrypted file unless an interrupted upload can resume from it
+            encrypted_files = list(self.encrypted_files_in_use)
+            self.encrypted_files_in_use.clear()
+            for encrypted_file in encrypted_files:
+                self.remove_unreferenced_file(encrypted_file)
+
+        imported = [result for result in results if result["result"] == "imported"]
+        if imported:
+            self.env["intune_app_changed"] = True
+            self.env["intuneappuploader_summary_result"] = {
+                "summary_text": "The following new items were imported into Intune:",
+                "report_fields": [
+                    "name",
+                    "version",
+                    "intune_app_id",
+                    "content_version_id",
+                    "content_upload",
+                ],
+                "data": {
+                    "name": app_displayname,
+                    "version": app_bundleVersion,
+                    "intune_app_id": imported[0]["intune_app_id"],
+                    "content_version_id": imported[0]["content_version_id"],
+                    "content_upload": imported[0]["content_upload"],
+                },
+            }
+            if len(tenants) > 1:
+                self.env["intuneappuploader_summary_result"]["report_fields"].insert(
+                    0, "tenant_id"
+                )
+                self.env["intuneappuploader_summary_result"]["data"][
+                    "tenant_id"
+                ] = imported[0]["tenant_id"]
+                self.env["intuneappuploader_summary_result"]["tenants"] = results
+
+        failed = [result for result in results if result["result"].startswith("failed")]
+        if failed:
+            raise ProcessorError(
+                f"Failed to upload app to tenant(s) {', '.join(result['tenant_id'] for result in failed)}"
+            )
 
 
 if __name__ == "__main__":
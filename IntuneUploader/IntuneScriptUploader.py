@@ -61,7 +61,10 @@ class IntuneScriptUploader(IntuneUploaderBase):
     output_variables = {
         "intunescriptuploader_summary_result": {
             "description": "Description of interesting results."
-        }
+        },
+        "intunescriptuploader_metrics": {
+            "description": "The wall-clock and CPU seconds of each phase and the number of Graph requests of the run."
+        },
     }
 
     def main(self):
@@ -77,13 +80,13 @@ class IntuneScriptUploader(IntuneUploaderBase):
             assignment_endpoint = self.BASE_ENDPOINT.replace(
                 "deviceShellScripts", "deviceManagementScripts"
             )
-            current_assignment = self.makeapirequest(
-                f"{assignment_endpoint}/{script_id}/assignments", self.token
+            current_assignment = list(
+                self.iter_graph_items(f"{assignment_endpoint}/{script_id}/assignments")
             )
             # Get the current group ids
             current_group_ids = [
                 c["target"].get("groupId")
-                for c in current_assignment["value"]
+                for c in current_assignment
                 if c["target"].get("groupId")
             ]
             # Check if the group id is not in the current assignments
@@ -109,7 +112,7 @@ class IntuneScriptUploader(IntuneUploaderBase):
                         }
                     )
 
-                for assignment in current_assignment["value"]:
+                for assignment in current_assignment:
                     data["deviceManagementScriptAssignments"].append(
                         {
                             "target": assignment["target"],
@@ -154,9 +157,10 @@ class IntuneScriptUploader(IntuneUploaderBase):
             raise ProcessorError(f"Path does not exist: {script_path}")
 
         # Get token
-        self.token = self.obtain_accesstoken(
-            self.CLIENT_ID, self.CLIENT_SECRET, self.TENANT_ID
-        )
+        with self.phase("auth"):
+            self.token = self.obtain_accesstoken(
+                self.CLIENT_ID, self.CLIENT_SECRET, self.TENANT_ID
+            )
 
         @dataclass
         class ShellScript:
@@ -186,13 +190,16 @@ class IntuneScriptUploader(IntuneUploaderBase):
 
         # Check if script exists in Intune
         params = {"$filter": f"displayName eq '{script_name}'"}
-        current_script = self.makeapirequest(self.BASE_ENDPOINT, self.token, params)
+        with self.phase("lookup"):
+            current_script = self.makeapirequest(self.BASE_ENDPOINT, self.token, params)
 
         if current_script["value"]:
             # Get script content
-            current_script_content = self.makeapirequest(
-                f"{self.BASE_ENDPOINT}/{current_script['value'][0]['id']}", self.token
-            )
+            with self.phase("lookup"):
+                current_script_content = self.makeapirequest(
+                    f"{self.BASE_ENDPOINT}/{current_script['value'][0]['id']}",
+                    self.token,
+                )
             # Check if script matches current script
             if current_script_content["scriptContent"] == script.scriptContent:
                 self.output(
@@ -204,19 +211,21 @@ class IntuneScriptUploader(IntuneUploaderBase):
                     f"Script '{script_name}' already exists but does not match current script. Updating script."
                 )
                 action = "update"
-                self.makeapirequestPatch(
-                    f"{self.BASE_ENDPOINT}('{current_script_content['id']}')",
-                    self.token,
-                    "",
-                    script_data,
-                )
+                with self.phase("upload"):
+                    self.makeapirequestPatch(
+                        f"{self.BASE_ENDPOINT}('{current_script_content['id']}')",
+                        self.token,
+                        "",
+                        script_data,
+                    )
 
         else:
             self.output(f"Script '{script_name}' does not exist. Creating script.")
             action = "create"
-            create_request = self.makeapirequestPost(
-                self.BASE_ENDPOINT, self.token, None, script_data, 201
-            )
+            with self.phase("upload"):
+                create_request = self.makeapirequestPost(
+                    self.BASE_ENDPOINT, self.token, None, script_data, 201
+                )
 
         if assignment_info and action != "none":
             # Assign script to groups
@@ -225,7 +234,8 @@ class IntuneScriptUploader(IntuneUploaderBase):
             else:
                 script_id = current_script["value"][0]["id"]
 
-            assign_script(self, script_id, assignment_info)
+            with self.phase("assignment"):
+                assign_script(self, script_id, assignment_info)
 
         self.env["intunescriptuploader_summary_result"] = {
             "summary_text": "Summary of IntuneScriptUploader results:",
@@ -14,7 +14,6 @@ import os
 import sys
 import time
 
-import requests
 from autopkglib import ProcessorError
 
 __all__ = ["IntuneSlackNotifier"]
@@ -86,12 +85,12 @@ class IntuneSlackNotifier(IntuneUploaderBase):
 
         def _post_slack_message(data):
             data = json.dumps(data)
-            response = requests.post(url=slack_webhook, data=data)
+            response = self.http_request("POST", slack_webhook, data=data)
 
             retry_count = 0
             while response.status_code != 200 and retry_count < 3:
                 time.sleep(2)
-                response = requests.post(url=slack_webhook, data=data)
+                response = self.http_request("POST", slack_webhook, data=data)
                 retry_count += 1
             if response.status_code != 200:
                 raise ProcessorError(
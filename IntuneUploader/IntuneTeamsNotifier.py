@@ -14,7 +14,6 @@ import os
 import sys
 import time
 
-import requests
 from autopkglib import ProcessorError
 
 __all__ = ["IntuneTeamsNotifier"]
@@ -123,13 +122,17 @@ class IntuneTeamsNotifier(IntuneUploaderBase):
             headers = {
                 "Content-Type": "application/json",
             }
-            response = requests.post(url=teams_webhook, data=data, headers=headers)
+            response = self.http_request(
+                "POST", teams_webhook, data=data, headers=headers
+            )
 
             retry_count = 0
             success_codes = [200, 201, 202, 204]
             while response.status_code not in success_codes and retry_count < 3:
                 time.sleep(2)
-                response = requests.post(url=teams_webhook, data=data, headers=headers)
+                response = self.http_request(
+                    "POST", teams_webhook, data=data, headers=headers
+                )
                 retry_count += 1
             if response.status_code not in success_codes:
                 raise ProcessorError(
@@ -0,0 +1,666 @@
+#!/usr/local/autopkg/python
+# -*- coding: utf-8 -*-
+
+"""
+IntuneUploaderApps looks up the apps and app categories of a tenant.
+"""
+
+import copy
+import fcntl
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+
+from autopkglib import ProcessorError
+
+from IntuneUploaderLib.IntuneUploaderGraph import GRAPH_URL
+
+__all__ = ["AppsMixin"]
+
+# Properties of the mobileApp base type, selected without a type
+MOBILE_APP_PROPERTIES = [
+    "id",
+    "displayName",
+    "description",
+    "publisher",
+    "notes",
+    "owner",
+    "developer",
+    "informationUrl",
+    "privacyInformationUrl",
+    "isFeatured",
+    "createdDateTime",
+    "lastModifiedDateTime",
+    "publishingState",
+    "roleScopeTagIds",
+]
+MACOS_APP_TYPES = ["macOSDmgApp", "macOSPkgApp", "macOSLobApp"]
+# Properties of each macOS app type, selected only on the types that define them
+MACOS_APP_TYPE_PROPERTIES = {
+    "macOSDmgApp": [
+        "committedContentVersion",
+        "fileName",
+        "size",
+        "primaryBundleId",
+        "primaryBundleVersion",
+        "includedApps",
+        "ignoreVersionDetection",
+        "minimumSupportedOperatingSystem",
+    ],
+    "macOSPkgApp": [
+        "committedContentVersion",
+        "fileName",
+        "size",
+        "primaryBundleId",
+        "primaryBundleVersion",
+        "includedApps",
+        "ignoreVersionDetection",
+        "minimumSupportedOperatingSystem",
+        "preInstallScript",
+        "postInstallScript",
+    ],
+    "macOSLobApp": [
+        "committedContentVersion",
+        "fileName",
+        "size",
+        "bundleId",
+        "buildNumber",
+        "versionNumber",
+        "childApps",
+        "identityVersion",
+        "ignoreVersionDetection",
+        "installAsManaged",
+        "minimumSupportedOperatingSystem",
+    ],
+}
+# App fields kept in the local app inventory
+APP_INVENTORY_FIELDS = [
+    "id",
+    "displayName",
+    "notes",
+    "primaryBundleId",
+    "primaryBundleVersion",
+    "bundleId",
+    "buildNumber",
+    "fileName",
+    "committedContentVersion",
+    "categories",
+]
+# $select values Graph rejected, apps are then requested in full and projected locally
+_unsupported_selects = set()
+# Filter matching the macOS app types handled by the processors
+MACOS_APPS_FILTER = "(isof('microsoft.graph.macOSDmgApp') or isof('microsoft.graph.macOSPkgApp') or isof('microsoft.graph.macOSLobApp'))"
+# Default seconds before the local app inventory is synced with Intune again
+APP_INVENTORY_TTL = 900
+# Maximum length of the display name part of a $filter in a bulk app lookup
+APP_LOOKUP_FILTER_LENGTH = 1500
+# Default seconds before the cached app category catalog is fetched again
+CATEGORY_CACHE_TTL = 3600
+# App category catalogs of this run, keyed by tenant ID
+_category_catalogs = {}
+_category_catalogs_lock = threading.Lock()
+
+
+class AppsMixin:
+    """Looks up apps and app categories in Intune and caches them."""
+
+    def select_app_fields(self, fields: list, app_types=None) -> str:
+        """Builds the $select value for the specified app fields.
+
+        Properties of the macOS app types are selected on each type that defines them,
+        fields no type defines are left out. Categories are expanded instead and
+        @odata.type is always returned.
+
+        Args:
+            fields (list): The app fields.
+            app_types (list, optional): The app types to select the properties on.
+                Defaults to MACOS_APP_TYPES.
+
+        Returns:
+            str: The $select value.
+        """
+        select = []
+        for field_name in fields:
+            if field_name in ("categories", "@odata.type"):
+                continue
+            if field_name in MOBILE_APP_PROPERTIES:
+                select.append(field_name)
+            else:
+                select.extend(
+                    f"microsoft.graph.{app_type}/{field_name}"
+                    for app_type in app_types or MACOS_APP_TYPES
+                    if field_name in MACOS_APP_TYPE_PROPERTIES.get(app_type, [])
+                )
+
+        return ",".join(select)
+
+    def project_app(self, app: dict, fields: list) -> dict:
+        """Picks the specified fields from an app, the ID and @odata.type are always kept.
+
+        Args:
+            app (dict): The app.
+            fields (list): The app fields.
+
+        Returns:
+            dict: The app with only the specified fields.
+        """
+        return {
+            key: value
+            for key, value in app.items()
+            if key in fields or key in ("id", "@odata.type")
+        }
+
+    def get_apps(self, endpoint: str, params=None, fields=None, app_types=None) -> list:
+        """Gets apps from Intune with only the specified fields.
+
+        If Graph rejects the $select with a 400 response, the apps are requested in
+        full and the fields are picked from them.
+
+        Args:
+            endpoint (str): The endpoint of the app collection or of a single app.
+            params (dict, optional): The query parameters to use for the request. Defaults to None.
+            fields (list, optional): The app fields to get. Defaults to None, which gets
+                all fields and the categories.
+            app_types (list, optional): The app types to select the properties on.
+                Defaults to MACOS_APP_TYPES.
+
+        Returns:
+            list: The apps.
+        """
+        params = dict(params or {})
+        if fields is None or "categories" in fields:
+            params["$expand"] = "categories"
+
+        collection = endpoint.endswith("/mobileApps")
+        if collection and self.env.get("GRAPH_PAGE_SIZE"):
+            params["$top"] = int(self.env.get("GRAPH_PAGE_SIZE"))
+
+        def _get(params):
+            response = self.make_graph_request("GET", endpoint, self.token, params)
+            # Graph answers 400 if it does not support the $select
+            if response.status_code == 400 and "$select" in params:
+                return None
+            if response.status_code != 200:
+                raise ProcessorError(
+                    "Request failed with ", response.status_code, " - ", response.text
+                )
+            page = json.loads(response.text)
+            if not collection:
+                return [page]
+
+            apps = page.get("value", [])
+            if page.get("@odata.nextLink"):
+                for next_page in self.iter_graph_pages(
+                    page["@odata.nextLink"], self.token
+                ):
+                    apps.extend(next_page.get("value", []))
+            return apps
+
+        if fields is None:
+            return _get(params)
+
+        select = self.select_app_fields(fields, app_types)
+        if select and select not in _unsupported_selects:
+            apps = _get({**params, "$select": select})
+            if apps is not None:
+                return apps
+            self.output(
+                f"Graph does not support $select={select}, getting full apps",
+                verbose_level=2,
+            )
+            _unsupported_selects.add(select)
+
+        return [self.project_app(app, fields) for app in _get(params)]
+
+    def get_app_inventory_ttl(self) -> float:
+        """Gets the seconds before the local app inventory is synced again.
+
+        Returns:
+            float: The APP_INVENTORY_TTL variable or its default, 0 disables the inventory.
+        """
+        return float(self.env.get("APP_INVENTORY_TTL", APP_INVENTORY_TTL))
+
+    def open_app_inventory(self, sync: bool = True) -> sqlite3.Connection:
+        """Opens the local app inventory of the tenant, syncing it if it is stale.
+
+        The inventory is a SQLite database in the cache directory holding the macOS apps
+        of the tenant, indexed by display name, bundle ID and version. It is shared by
+        all processors and recipes and is fully synced with Intune once it is older than
+        APP_INVENTORY_TTL seconds. A lock file keeps concurrent runs from syncing at the
+        same time.
+
+        Args:
+            sync (bool, optional): Whether to sync the inventory if it is stale. Callers
+                that only write rows or sync the rows they read pass False. Defaults to True.
+
+        Returns:
+            sqlite3.Connection: A connection to the inventory.
+        """
+        inventory_file = os.path.join(
+            self.get_cache_dir(),
+            f"apps_{hashlib.sha256(self.TENANT_ID.encode()).hexdigest()}.sqlite",
+        )
+        conn = sqlite3.connect(inventory_file, timeout=60)
+        conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS apps (
+                id TEXT PRIMARY KEY,
+                display_name TEXT COLLATE NOCASE,
+                bundle_id TEXT,
+                version TEXT,
+                odata_type TEXT,
+                data TEXT
+            );
+            CREATE INDEX IF NOT EXISTS apps_display_name ON apps (display_name);
+            CREATE INDEX IF NOT EXISTS apps_bundle_id ON apps (bundle_id, version);
+            CREATE TABLE IF NOT EXISTS sync (key TEXT PRIMARY KEY, value TEXT);
+            """
+        )
+        if not sync:
+            return conn
+
+        with open(f"{inventory_file}.lock", "a", encoding="utf-8") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                row = conn.execute(
+                    "SELECT value FROM sync WHERE key = 'synced_at'"
+                ).fetchone()
+                if (
+                    not row
+                    or float(row[0]) + self.get_app_inventory_ttl() <= time.time()
+                ):
+                    self.sync_app_inventory(conn)
+                    self.app_inventory_synced = True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+        return conn
+
+    def sync_app_inventory(self, conn: sqlite3.Connection, displayname=None) -> list:
+        """Replaces the apps in the local inventory with the current apps from Intune.
+
+        Args:
+            conn (sqlite3.Connection): A connection to the inventory.
+            displayname (str, optional): Only sync the apps with this display name.
+                Defaults to None, which syncs all apps.
+
+        Returns:
+            list: The synced apps.
+        """
+        params = {"$filter": MACOS_APPS_FILTER}
+        if displayname is not None:
+            params["$filter"] += " and displayName eq '{}'".format(
+                displayname.replace("'", "''")
+            )
+        else:
+            self.output("Syncing the local app inventory with Intune", verbose_level=2)
+        apps = self.get_apps(
+            f"{GRAPH_URL}/beta/deviceAppManagement/mobileApps",
+            params,
+            APP_INVENTORY_FIELDS,
+        )
+
+        with conn:
+            if displayname is not None:
+                conn.execute("DELETE FROM apps WHERE display_name = ?", (displayname,))
+            else:
+                conn.execute("DELETE FROM apps")
+                conn.execute(
+                    "INSERT OR REPLACE INTO sync VALUES ('synced_at', ?)",
+                    (str(time.time()),),
+                )
+            conn.executemany(
+                "INSERT OR REPLACE INTO apps VALUES (?, ?, ?, ?, ?, ?)",
+                [self.app_inventory_row(app) for app in apps],
+            )
+
+        return apps
+
+    def app_inventory_row(self, app: dict) -> tuple:
+        """Gets the row of an app in the local inventory.
+
+        Args:
+            app (dict): The app.
+
+        Returns:
+            tuple: The values of the row.
+        """
+        return (
+            app["id"],
+            app.get("displayName"),
+            app.get("primaryBundleId") or app.get("bundleId"),
+            app.get("primaryBundleVersion") or app.get("buildNumber"),
+            app.get("@odata.type"),
+            json.dumps(app),
+        )
+
+    def update_app_inventory(self, app_id: str) -> None:
+        """Updates an app in the local inventory after it was created or changed.
+
+        Args:
+            app_id (str): The ID of the app.
+        """
+        if not self.get_app_inventory_ttl():
+            return
+
+        app = self.get_apps(
+            f"{GRAPH_URL}/beta/deviceAppManagement/mobileApps/{app_id}",
+            fields=APP_INVENTORY_FIELDS,
+        )[0]
+        with closing(self.open_app_inventory(sync=False)) as conn:
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO apps VALUES (?, ?, ?, ?, ?, ?)",
+                    self.app_inventory_row(app),
+                )
+
+    def remove_from_app_inventory(self, app_ids: list) -> None:
+        """Removes deleted apps from the local inventory.
+
+        Args:
+            app_ids (list): The IDs of the apps.
+        """
+        if not self.get_app_inventory_ttl():
+            return
+
+        with closing(self.open_app_inventory(sync=False)) as conn:
+            with conn:
+                conn.executemany(
+                    "DELETE FROM apps WHERE id = ?", [(app_id,) for app_id in app_ids]
+                )
+
+    def match_current_app(
+        self, matching_apps: list, displayname: str, version: int, odata_type: str
+    ) -> tuple:
+        """Finds the current app among the apps matching its display name.
+
+        Args:
+            matching_apps (list): The apps matching the display name.
+            displayname (str): The display name of the app.
+            version (int): The version of the app.
+            odata_type (str): The @odata.type of the app.
+
+        Returns:
+            tuple: The result, "update", "current" or None, and the data of the app.
+        """
+        request = [
+            app
+            for app in matching_apps
+            if app["displayName"] == displayname
+            and app.get("primaryBundleVersion") == version
+            or app.get("buildNumber") == version
+            and app["@odata.type"] == odata_type
+        ]
+        result = None
+        data = {}
+
+        if request:
+            for item in request:
+                item_version = (
+                    item.get("primaryBundleVersion")
+                    if item.get("primaryBundleVersion")
+                    else item.get("buildNumber")
+                )
+                if item_version < version:
+                    result = "update"
+                    item["primaryBundleVersion"] = item_version
+                    data = item
+                else:
+                    result = "current"
+                    item["primaryBundleVersion"] = item_version
+                    data = item
+
+        return result, data
+
+    def get_matching_apps_bulk(
+        self, displaynames: list, refresh: bool = False, fields=None
+    ) -> dict:
+        """Gets the apps from Intune that match each of the specified display names.
+
+        The apps are read from the local app inventory in one query or, if it is
+        disabled or does not hold all of the fields, requested from Graph with
+        displayName filters split into chunks of at most APP_LOOKUP_FILTER_LENGTH
+        characters.
+
+        Args:
+            displaynames (list): The display names of the apps.
+            refresh (bool, optional): Whether to get the apps from Intune and update the
+                inventory with them. Defaults to False.
+            fields (list, optional): The app fields the caller uses. Defaults to None,
+                which gets all fields.
+
+        Returns:
+            dict: The list of matching apps for each display name.
+        """
+        displaynames = list(dict.fromkeys(displaynames))
+
+        # The display name is needed to match the apps to the display names
+        lookup_fields = None if fields is None else sorted({*fields, "displayName"})
+        if (
+            self.get_app_inventory_ttl()
+            and lookup_fields is not None
+            and set(lookup_fields) <= set(APP_INVENTORY_FIELDS + ["@odata.type"])
+        ):
+            # Refreshed rows are synced by display name, not with the whole inventory
+            with closing(self.open_app_inventory(sync=not refresh)) as conn:
+                if refresh:
+                    apps = []
+                    for displayname in displaynames:
+                        apps.extend(self.sync_app_inventory(conn, displayname))
+                else:
+                    apps = []
+                    # Stay below the SQLite limit of variables in a statement
+                    for i in range(0, len(displaynames), 500):
+                        chunk = displaynames[i : i + 500]
+                        apps.extend(
+                            json.loads(row[0])
+                            for row in conn.execute(
+                                f"SELECT data FROM apps WHERE display_name IN ({', '.join('?' * len(chunk))})",
+                                chunk,
+                            )
+                        )
+            apps = [self.project_app(app, lookup_fields) for app in apps]
+        else:
+            apps = []
+            clauses = [
+                "displayName eq '{}'".format(displayname.replace("'", "''"))
+                for displayname in displaynames
+            ]
+            while clauses:
+                chunk = [clauses.pop(0)]
+                while (
+                    clauses
+                    and len(" or ".join(chunk + clauses[:1]))
+                    <= APP_LOOKUP_FILTER_LENGTH
+                ):
+                    chunk.append(clauses.pop(0))
+                params = {"$filter": f"{MACOS_APPS_FILTER} and ({' or '.join(chunk)})"}
+                apps.extend(self.get_apps(self.BASE_ENDPOINT, params, lookup_fields))
+
+        # Display names are matched case insensitively, like the Graph filter does
+        matches = {displayname.lower(): [] for displayname in displaynames}
+        for app in apps:
+            if app["displayName"].lower() in matches:
+                matches[app["displayName"].lower()].append(
+                    app if fields is None else self.project_app(app, fields)
+                )
+
+        return {
+            displayname: copy.deepcopy(matches[displayname.lower()])
+            for displayname in displaynames
+        }
+
+    def get_category_catalog(self, category_names=None) -> dict:
+        """Gets the app categories of the tenant as a dictionary of names to IDs.
+
+        The catalog is cached in memory and in the cache directory, so it is shared by
+        all processors and recipes. It is fetched again once it is older than
+        CATEGORY_CACHE_TTL seconds or when one of the category names is not in it,
+        in case the category was created elsewhere.
+
+        Args:
+            category_names (list, optional): The category names the caller needs. Defaults to None.
+
+        Returns:
+            dict: The IDs of the app categories by name.
+        """
+        catalog_file = self.get_category_catalog_file()
+        ttl = float(self.env.get("CATEGORY_CACHE_TTL", CATEGORY_CACHE_TTL))
+
+        with _category_catalogs_lock:
+            catalog = _category_catalogs.get(self.TENANT_ID)
+            if catalog is None:
+                try:
+                    with open(catalog_file, "r", encoding="utf-8") as f:
+                        catalog = json.load(f)
+                except (OSError, ValueError):
+                    catalog = None
+
+            if (
+                catalog is None
+                or catalog["fetched_at"] + ttl <= time.time()
+                or any(
+                    name not in catalog["categories"] for name in category_names or []
+                )
+            ):
+                catalog = {
+                    "fetched_at": time.time(),
+                    "categories": {
+                        category["displayName"]: category["id"]
+                        for category in self.iter_graph_items(
+                            f"{GRAPH_URL}/beta/deviceAppManagement/mobileAppCategories",
+                            {"$select": "id,displayName"},
+                        )
+                    },
+                }
+                self.save_category_catalog(catalog_file, catalog)
+
+            _category_catalogs[self.TENANT_ID] = catalog
+
+            return dict(catalog["categories"])
+
+    def get_category_catalog_file(self) -> str:
+        """Returns the path of the cached app category catalog of the tenant.
+
+        Returns:
+            str: The path of the catalog file.
+        """
+        return os.path.join(
+            self.get_cache_dir(),
+            f"categories_{hashlib.sha256(self.TENANT_ID.encode()).hexdigest()}.json",
+        )
+
+    def save_category_catalog(self, catalog_file: str, catalog: dict) -> None:
+        """Writes the app category catalog to the cache directory.
+
+        Args:
+            catalog_file (str): The path of the catalog file.
+            catalog (dict): The catalog.
+        """
+        fd = os.open(
+            f"{catalog_file}.tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600
+        )
+        with os.fdopen(fd, "w") as f:
+            json.dump(catalog, f)
+        os.replace(f"{catalog_file}.tmp", catalog_file)
+
+    def invalidate_category_catalog(self) -> None:
+        """Forgets the cached app category catalog of the tenant."""
+        catalog_file = self.get_category_catalog_file()
+        with _category_catalogs_lock:
+            _category_catalogs.pop(self.TENANT_ID, None)
+            if os.path.exists(catalog_file):
+                os.unlink(catalog_file)
+
+    def get_app_changes(self, app: dict, app_id: str) -> dict:
+        """Gets the fields of an app that differ from the app in Intune.
+
+        The current values are requested without the icon, which is compared by the
+        SHA-256 digest recorded when it was last sent. Nested values only count as
+        changed if one of the values in the app differs, properties Intune adds are
+        ignored. Fields the app type does not define are never counted as changed.
+
+        Args:
+            app (dict): The app data to update the app with.
+            app_id (str): The ID of the app in Intune.
+
+        Returns:
+            dict: The changed fields and the @odata.type of the app.
+        """
+
+        def _differs(value, current):
+            if isinstance(value, dict) and isinstance(current, dict):
+                return any(
+                    _differs(v, current.get(k))
+                    for k, v in value.items()
+                    if k != "@odata.type"
+                )
+            if isinstance(value, list) and isinstance(current, list):
+                return len(value) != len(current) or any(
+                    _differs(v, c) for v, c in zip(value, current, strict=True)
+                )
+            return value != current
+
+        app_type = app["@odata.type"].split(".")[-1]
+        fields = [
+            key
+            for key in app
+            if key not in ("@odata.type", "largeIcon")
+            and (
+                key in MOBILE_APP_PROPERTIES
+                or key in MACOS_APP_TYPE_PROPERTIES.get(app_type, [key])
+            )
+        ]
+        current_app = self.get_apps(
+            f"{self.BASE_ENDPOINT}/{app_id}", fields=fields, app_types=[app_type]
+        )[0]
+        changes = {
+            key: value
+            for key, value in app.items()
+            if key in fields and _differs(value, current_app.get(key))
+        }
+
+        if app.get("largeIcon"):
+            with closing(self.open_upload_ledger()) as conn:
+                row = conn.execute(
+                    "SELECT sha256 FROM icons WHERE tenant_id = ? AND app_id = ?",
+                    (self.TENANT_ID, app_id),
+                ).fetchone()
+            if not row or row[0] != self.get_icon_sha256(app):
+                changes["largeIcon"] = app["largeIcon"]
+
+        changes["@odata.type"] = app["@odata.type"]
+
+        return changes
+
+    def get_icon_sha256(self, app: dict) -> str:
+        """Calculates the SHA-256 digest of the icon of an app.
+
+        Args:
+            app (dict): The app data.
+
+        Returns:
+            str: The hex digest of the icon.
+        """
+        return hashlib.sha256(json.dumps(app["largeIcon"]).encode()).hexdigest()
+
+    def record_app_icon(self, app: dict, app_id: str) -> None:
+        """Records the digest of the icon sent for an app in the upload ledger.
+
+        Args:
+            app (dict): The app data that was sent.
+            app_id (str): The ID of the app in Intune.
+        """
+        if not app.get("largeIcon"):
+            return
+
+        with closing(self.open_upload_ledger()) as conn:
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO icons VALUES (?, ?, ?)",
+                    (self.TENANT_ID, app_id, self.get_icon_sha256(app)),
+                )
@@ -8,52 +8,49 @@ Created by Tobias Almén
 """
 
 import base64
-import hashlib
-import hmac
 import json
 import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
-import requests
 from autopkglib import Processor, ProcessorError
-from cryptography.hazmat.primitives import padding
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 
-
-class IntuneUploaderBase(Processor):
+from IntuneUploaderLib.IntuneUploaderApps import (
+    AppsMixin,
+    _category_catalogs,
+    _category_catalogs_lock,
+)
+from IntuneUploaderLib.IntuneUploaderContent import (
+    AZURE_STORAGE_URI_TIMEOUT,
+    COMMIT_TIMEOUT,
+    COMMIT_TIMEOUT_PER_GB,
+    ContentMixin,
+)
+from IntuneUploaderLib.IntuneUploaderGraph import GRAPH_URL, GraphMixin
+from IntuneUploaderLib.IntuneUploaderHTTP import HTTPMixin
+from IntuneUploaderLib.IntuneUploaderRun import RunMixin
+
+
+class IntuneUploaderBase(
+    AppsMixin, ContentMixin, GraphMixin, HTTPMixin, RunMixin, Processor
+):
     """IntuneUploaderBase processor"""
 
-    def obtain_accesstoken(
-        self, client_id: str, client_secret: str, tenant_id: str
-    ) -> dict:
-        """This function obtains an access token from the Microsoft Graph API.
+    def get_cache_dir(self) -> str:
+        """Gets the directory used for caches shared by all recipes, creating it if needed.
 
-        Args:
-            client_id (str): The client ID to use for authenticating the request.
-            client_secret (str): The client secret to use for authenticating the request.
-            tenant_id (str): The tenant ID to use for authenticating the request.
+        The directory is IntuneUploader in the AutoPkg CACHE_DIR.
 
         Returns:
-            dict: The response from the request as a dictionary.
+            str: The path to the cache directory.
         """
-
-        url = f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token"
-        headers = {"Content-Type": "application/x-www-form-urlencoded"}
-        data = {
-            "grant_type": "client_credentials",
-            "client_id": client_id,
-            "client_secret": client_secret,
-            "scope": "https://graph.microsoft.com/.default",
-        }
-
-        response = requests.post(url, headers=headers, data=data)
-
-        if response.status_code != 200:
-            raise ProcessorError(
-                f"Failed to obtain access token. Status code: {response.status_code}"
-            )
-        response = json.loads(response.text)
-        return response
+        cache_dir = os.path.join(
+            self.env.get("CACHE_DIR") or os.path.expanduser("~/Library/AutoPkg/Cache"),
+            "IntuneUploader",
+        )
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        return cache_dir
 
     def makeapirequest(self, endpoint: str, token: dict, q_param=None) -> dict:
         """This function makes a request to the Graph API and returns the response as a dictionary.
@@ -67,55 +64,11 @@ class IntuneUploaderBase(Processor):
             dict: The response from the request as a dictionary.
         """
 
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": "Bearer {0}".format(token["access_token"]),
-        }
-        retry_response_codes = [502, 503, 504]
-        if q_param is not None:
-            response = requests.get(endpoint, headers=headers, params=q_param)
-            if response.status_code in retry_response_codes:
-                self.output(
-                    "Ran into issues with Graph request, waiting 10 seconds and trying again..."
-                )
-                time.sleep(10)
-                response = requests.get(endpoint, headers=headers)
-            elif response.status_code == 429:
-                self.output(
-                    f"Hit Graph throttling, trying again after {response.headers['Retry-After']} seconds"
-                )
-                while response.status_code == 429:
-                    time.sleep(int(response.headers["Retry-After"]))
-                    response = requests.get(endpoint, headers=headers)
-        else:
-            response = requests.get(endpoint, headers=headers)
-            if response.status_code in retry_response_codes:
-                self.output(
-                    "Ran into issues with Graph request, waiting 10 seconds and trying again..."
-                )
-                time.sleep(10)
-                response = requests.get(endpoint, headers=headers)
-            elif response.status_code == 429:
-                self.output(
-                    f"Hit Graph throttling, trying again after {response.headers['Retry-After']} seconds"
-                )
-                while response.status_code == 429:
-                    time.sleep(int(response.headers["Retry-After"]))
-                    response = requests.get(endpoint, headers=headers)
-
-        if response.status_code != 200:
-            raise ProcessorError(
-                "Request failed with ", response.status_code, " - ", response.text
-            )
-        json_data = json.loads(response.text)
-
-        if "@odata.nextLink" in json_data.keys():
-            record = self.makeapirequest(json_data["@odata.nextLink"], token)
-            entries = len(record["value"])
-            count = 0
-            while count < entries:
-                json_data["value"].append(record["value"][count])
-                count += 1
+        pages = self.iter_graph_pages(endpoint, token, q_param)
+        json_data = next(pages)
+        # Merge the items of any following pages into the first page
+        for page in pages:
+            json_data["value"].extend(page["value"])
 
         return json_data
 
@@ -140,32 +93,13 @@ class IntuneUploaderBase(Processor):
             dict: If there is a response, the response from the request as a dictionary.
         """
 
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": "Bearer {0}".format(token["access_token"]),
-        }
-
-        if q_param is not None:
-            response = requests.post(
-                postEndpoint, headers=headers, params=q_param, data=json_data
-            )
-        else:
-            response = requests.post(postEndpoint, headers=headers, data=json_data)
+        response = self.make_graph_request(
+            "POST", postEndpoint, token, q_param, json_data
+        )
         if response.status_code == status_code:
             if response.text:
                 json_data = json.loads(response.text)
                 return json_data
-        elif response.status_code == 429:
-            self.output(
-                f"Hit Graph throttling, trying again after {response.headers['Retry-After']} seconds"
-            )
-            while response.status_code == 429:
-                time.sleep(int(response.headers["Retry-After"]))
-                response = requests.post(postEndpoint, headers=headers, data=json_data)
-        elif response.status_code == 412:
-            self.output("Precondition failed, trying again...")
-            time.sleep(10)
-            response = requests.post(postEndpoint, headers=headers, data=json_data)
         else:
             raise ProcessorError(
                 "Request failed with ", response.status_code, " - ", response.text
@@ -189,17 +123,9 @@ class IntuneUploaderBase(Processor):
             status_code (int, optional): The status code to check for. Defaults to 200.
         """
 
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": "Bearer {0}".format(token["access_token"]),
-        }
-
-        if q_param is not None:
-            response = requests.patch(
-                patchEndpoint, headers=headers, params=q_param, data=json_data
-            )
-        else:
-            response = requests.patch(patchEndpoint, headers=headers, data=json_data)
+        response = self.make_graph_request(
+            "PATCH", patchEndpoint, token, q_param, json_data
+        )
         if response.status_code == status_code:
             pass
         else:
@@ -228,17 +154,9 @@ class IntuneUploaderBase(Processor):
             ProcessorError: If the request fails.
         """
 
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": "Bearer {0}".format(token["access_token"]),
-        }
-
-        if q_param is not None:
-            response = requests.delete(
-                deleteEndpoint, headers=headers, params=q_param, data=jdata
-            )
-        else:
-            response = requests.delete(deleteEndpoint, headers=headers, data=jdata)
+        response = self.make_graph_request(
+            "DELETE", deleteEndpoint, token, q_param, jdata
+        )
         if response.status_code == status_code:
             pass
         else:
@@ -246,141 +164,107 @@ class IntuneUploaderBase(Processor):
                 "Request failed with ", response.status_code, " - ", response.text
             )
 
-    def encrypt_app(self) -> tuple:
-        """Encrypts the app with AES-256 in CBC mode.
-
-        Returns:
-            tuple: Tuple containing:
-                str: The encrypted app.
-                dict: The encryption info.
-        """
-        encryptionKey = os.urandom(32)
-        hmacKey = os.urandom(32)
-        initializationVector = os.urandom(16)
-        profileIdentifier = "ProfileVersion1"
-        fileDigestAlgorithm = "SHA256"
-
-        with open(self.app_file, "rb") as f:
-            plaintext = f.read()
-
-        # Pad the plaintext to a multiple of 16 bytes
-        padder = padding.PKCS7(128).padder()
-        padded_plaintext = padder.update(plaintext) + padder.finalize()
-
-        # Encrypt the padded plaintext using AES-256 in CBC mode
-        cipher = Cipher(algorithms.AES(encryptionKey), modes.CBC(initializationVector))
-        encryptor = cipher.encryptor()
-        encrypted_data = encryptor.update(padded_plaintext) + encryptor.finalize()
-
-        # Combine the IV and encrypted data into a single byte string
-        iv_data = initializationVector + encrypted_data
-
-        # Generate a HMAC-SHA256 signature of the IV and encrypted data
-        h = hmac.new(hmacKey, iv_data, hashlib.sha256)
-        signature = h.digest()
-
-        # Combine the signature and IV + encrypted data into a single byte string
-        encrypted_pkg = signature + iv_data
-
-        # Generate a base64-encoded string of the encrypted package (unused)
-        # encoded_pkg = base64.b64encode(encrypted_pkg).decode()
-
-        # Generate a base64-encoded string of the encryption key
-        encoded_key = base64.b64encode(encryptionKey).decode()
-
-        # Generate a base64-encoded string of the HMAC key
-        encoded_hmac_key = base64.b64encode(hmacKey).decode()
-
-        # Generate a base64-encoded string of the file digest
-        filebytes = open(self.app_file, "rb").read()
-        filehash_sha256 = hashlib.sha256(filebytes)
-        fileDigest = base64.b64encode(filehash_sha256.digest()).decode()
-
-        # Generate the file encryption info dictionary
-        fileEncryptionInfo = {}
-        fileEncryptionInfo["@odata.type"] = "#microsoft.graph.fileEncryptionInfo"
-        fileEncryptionInfo["encryptionKey"] = encoded_key
-        fileEncryptionInfo["macKey"] = encoded_hmac_key
-        fileEncryptionInfo["initializationVector"] = base64.b64encode(
-            initializationVector
-        ).decode()
-        fileEncryptionInfo["profileIdentifier"] = profileIdentifier
-        fileEncryptionInfo["fileDigestAlgorithm"] = fileDigestAlgorithm
-        fileEncryptionInfo["fileDigest"] = fileDigest
-        fileEncryptionInfo["mac"] = base64.b64encode(signature).decode()
-
-        return (encrypted_pkg, fileEncryptionInfo)
-
-    def appFile(self, encrypted_app_file: str) -> dict:
+    def appFile(self) -> dict:
         """This function creates the appFile dictionary for the Microsoft Graph API.
 
-        Args:
-            encrypted_app_file (str): The path to the encrypted application file.
+        The encrypted size is calculated from the size of the app, so the app does not
+        have to be encrypted first.
 
         Returns:
             dict: The appFile dictionary.
         """
+        size = os.path.getsize(self.app_file)
         appFile = {}
         appFile["@odata.type"] = "#microsoft.graph.mobileAppContentFile"
         appFile["name"] = os.path.basename(self.app_file)
-        appFile["size"] = os.path.getsize(self.app_file)
-        appFile["sizeEncrypted"] = os.path.getsize(encrypted_app_file)
+        appFile["size"] = size
+        # Signature and IV followed by the data, PKCS7 padded to a multiple of 16 bytes
+        appFile["sizeEncrypted"] = 32 + 16 + (size // 16 + 1) * 16
         appFile["manifest"] = None
         appFile["isDependency"] = False
         return appFile
 
-    def create_blocklist(self, file_path: str, azure_storage_uri: str) -> None:
+    def create_blocklist(
+        self,
+        file_path: str,
+        azure_storage_uri: str,
+        concurrency: int = 1,
+        upload_state: dict = None,
+    ) -> None:
         """Uploads a file to Azure Blob Storage using the block list upload mechanism.
 
+        Blocks are uploaded concurrently by a pool of workers, the block list is
+        always committed in file order.
+
         Args:
             file_path (str): The path to the file to upload.
             azure_storage_uri (str): The URI of the Azure Blob Storage container to upload the file to.
+            concurrency (int, optional): The number of blocks to upload at the same time. Defaults to 1.
+            upload_state (dict, optional): The persisted upload state. If provided, uploaded blocks
+                are recorded in it and blocks Azure already holds are not uploaded again. Defaults to None.
         """
         # Set the chunk size to 6 MB
         chunk_size = 6 * 1024 * 1024
+        concurrency = max(1, int(concurrency))
+        file_size = os.path.getsize(file_path)
+        state_lock = threading.Lock()
+
+        # Generate a block ID for each chunk of the file
+        block_count = -(-file_size // chunk_size)
+        block_ids = [
+            self.get_block_id(block_index) for block_index in range(block_count)
+        ]
 
-        # Open the file in binary mode
-        with open(file_path, "rb") as f:
-            # Initialize the block IDs list and the block index
-            block_ids = []
-            block_index = 0
+        # When resuming, only upload the blocks Azure does not already hold
+        pending_blocks = list(range(block_count))
+        if upload_state and upload_state["blocks"]:
+            uncommitted_blocks = self.get_uncommitted_blocks(azure_storage_uri)
+            pending_blocks = [
+                block_index
+                for block_index in pending_blocks
+                if uncommitted_blocks.get(block_ids[block_index])
+                != min(chunk_size, file_size - block_index * chunk_size)
+            ]
+            self.output(
+                f"Azure Storage already holds {block_count - len(pending_blocks)} of {block_count} blocks, "
+                f"uploading the remaining {len(pending_blocks)}"
+            )
+            upload_state["blocks"] = [
+                block_ids[block_index]
+                for block_index in sorted(set(range(block_count)) - set(pending_blocks))
+            ]
 
-            # Read the file in chunks and upload each chunk as a block
-            while True:
+        def _upload_block(block_index: int) -> int:
+            # Each worker reads its own chunk so only one chunk per worker is in memory
+            with open(file_path, "rb") as f:
+                f.seek(block_index * chunk_size)
                 chunk = f.read(chunk_size)
-                if not chunk:
-                    break
+            self.count_metric("bytes_read", len(chunk))
 
-                # Generate a block ID for the current chunk
-                block_id = base64.b64encode(f"block-{block_index:04}".encode()).decode()
+            # Upload the chunk as a block
+            self.put_block(azure_storage_uri, block_ids[block_index], chunk)
 
-                # Upload the chunk as a block
-                uri = f"{azure_storage_uri}&comp=block&blockid={block_id}"
-                headers = {"x-ms-blob-type": "BlockBlob"}
-                try:
-                    r = requests.put(uri, headers=headers, data=chunk)
-                except:
-                    raise ProcessorError("Failed to upload block")
+            if upload_state is not None:
+                with state_lock:
+                    upload_state["blocks"].append(block_ids[block_index])
+                    self.save_upload_state(upload_state)
 
-                # Add the block ID to the list of block IDs
-                block_ids.append(block_id)
+            return len(chunk)
 
-                # Increment the block index
-                block_index += 1
+        start_time = time.monotonic()
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        try:
+            uploaded_bytes = sum(executor.map(_upload_block, pending_blocks))
+        finally:
+            executor.shutdown(cancel_futures=True)
+        elapsed = max(time.monotonic() - start_time, 0.001)
 
-            # Generate the block list XML
-            block_list_xml = "<BlockList>"
-            for block_id in block_ids:
-                block_list_xml += f"<Latest>{block_id}</Latest>"
-            block_list_xml += "</BlockList>"
-
-            # Upload the block list XML
-            uri = f"{azure_storage_uri}&comp=blocklist"
-            headers = {"Content-Type": "application/xml"}
-            r = requests.put(uri, headers=headers, data=block_list_xml)
+        self.output(
+            f"Uploaded {len(pending_blocks)} blocks ({uploaded_bytes / 1048576:.1f} MB) in {elapsed:.1f} seconds "
+            f"({uploaded_bytes / 1048576 / elapsed:.1f} MB/s) using {concurrency} worker(s)"
+        )
 
-            if r.status_code != 201:
-                raise ProcessorError("Failed to upload block list XML")
+        self.put_block_list(azure_storage_uri, block_ids)
 
     def get_file_content_status(self) -> dict:
         """Returns the status of a file upload.
@@ -393,73 +277,79 @@ class IntuneUploaderBase(Processor):
 
     def delete_app(self) -> None:
         """
-        Deletes an app from Intune.
+        Deletes an app from Intune, also once the runtime budget is spent. An app
+        that was already deleted is not deleted again.
         """
-        if self.request.get("id") and self.content_update is False:
-            self.makeapirequestDelete(
-                f"{self.BASE_ENDPOINT}/{self.request['id']}", self.token
-            )
+        if (
+            self.request.get("id")
+            and self.content_update is False
+            and self.request["id"] != getattr(self, "deleted_app_id", None)
+        ):
+            with self.ignore_deadline():
+                self.makeapirequestDelete(
+                    f"{self.BASE_ENDPOINT}/{self.request['id']}", self.token
+                )
+            self.deleted_app_id = self.request["id"]
+            self.remove_from_app_inventory([self.request["id"]])
 
-    def wait_for_file_upload(self) -> None:
+    def wait_for_file_upload(self) -> dict:
         """Waits for a file to be uploaded.
 
+        The timeout is COMMIT_TIMEOUT seconds plus COMMIT_TIMEOUT_PER_GB seconds for each
+        GB of the app, both can be set as variables.
+
+        Returns:
+            dict: The file content status dictionary.
+
         Raises:
             ProcessorError: If the file upload fails or times out.
         """
-        attempt = 1
-        status = self.get_file_content_status()
-
-        while status["uploadState"] != "commitFileSuccess":
-            time.sleep(5)
-            status = self.get_file_content_status()
-            attempt += 1
-            if status["uploadState"] == "commitFileFailed":
-                self.delete_app()
-                raise ProcessorError("Failed to commit file")
-            if attempt > 20:
-                self.delete_app()
-                raise ProcessorError("Timed out waiting for file upload to complete")
-
-    def wait_for_azure_storage_uri(self) -> None:
+        size_gb = os.path.getsize(self.app_file) / 1024**3
+        timeout = float(
+            self.env.get("COMMIT_TIMEOUT") or COMMIT_TIMEOUT
+        ) + size_gb * float(
+            self.env.get("COMMIT_TIMEOUT_PER_GB") or COMMIT_TIMEOUT_PER_GB
+        )
+        return self.wait_for_upload_state(
+            "commitFileSuccess", "commitFileFailed", timeout, "commit file"
+        )
+
+    def wait_for_azure_storage_uri(self) -> dict:
         """Waits for an Azure Storage upload URL to be generated.
 
+        The timeout is AZURE_STORAGE_URI_TIMEOUT seconds, it can be set as a variable.
+
+        Returns:
+            dict: The file content status dictionary.
+
         raises:
             ProcessorError: If the Azure Storage upload URL request fails or times out.
         """
-        attempt = 1
-        status = self.get_file_content_status()
-
-        while status["uploadState"] != "azureStorageUriRequestSuccess":
-            time.sleep(5)
-            status = self.get_file_content_status()
-            attempt += 1
-            if status["uploadState"] == "azureStorageUriRequestFailed":
-                self.delete_app()
-                raise ProcessorError("Failed to get the Azure Storage upload URL")
-            if attempt > 20:
-                self.delete_app()
-                raise ProcessorError(
-                    "Timed out waiting for the Azure Storage upload URL"
-                )
+        return self.wait_for_upload_state(
+            "azureStorageUriRequestSuccess",
+            "azureStorageUriRequestFailed",
+            float(
+                self.env.get("AZURE_STORAGE_URI_TIMEOUT") or AZURE_STORAGE_URI_TIMEOUT
+            ),
+            "get the Azure Storage upload URL",
+        )
 
-    def get_matching_apps(self, displayname: str) -> list:
+    def get_matching_apps(
+        self, displayname: str, refresh: bool = False, fields=None
+    ) -> list:
         """Gets a list of apps from Intune that match the specified display name.
 
         Args:
             displayname (str): The display name of the app.
+            refresh (bool, optional): Whether to get the apps from Intune and update the
+                inventory with them. Defaults to False.
+            fields (list, optional): The app fields the caller uses. Defaults to None,
+                which gets all fields.
 
         Returns:
             list: A list of apps that match the specified display name.
         """
-        params = {
-            "$filter": f"(isof('microsoft.graph.macOSDmgApp') or isof('microsoft.graph.macOSPkgApp') or isof('microsoft.graph.macOSLobApp')) and displayName eq '{displayname}'",
-            "$expand": "categories",
-        }
-        request = self.makeapirequest(
-            f"{self.BASE_ENDPOINT}", self.token, q_param=params
-        )
-
-        return request["value"]
+        return self.get_matching_apps_bulk([displayname], refresh, fields)[displayname]
 
     def get_app_categories(self) -> list:
         """Gets a list of app categories from Intune.
@@ -467,44 +357,50 @@ class IntuneUploaderBase(Processor):
         Returns:
             list: A list of app categories.
         """
-        categories = []
-
-        request = self.makeapirequest(
-            "https://graph.microsoft.com/beta/deviceAppManagement/mobileAppCategories",
-            self.token,
-        )
-
-        for category in request["value"]:
-            categories.append(category["displayName"])
-
-        return categories
+        return list(self.get_category_catalog())
 
     def create_app_categories(self, categories: list) -> list:
         """Creates a list of app categories in Intune.
 
+        The created categories are added to the cached category catalog.
+
         Args:
             categories (list): The categories to create.
 
         Returns:
             list: A list of the created categories.
         """
-        created_categories = []
-        for category in categories:
-            data = json.dumps({"displayName": category})
-            request = self.makeapirequestPost(
-                "https://graph.microsoft.com/beta/deviceAppManagement/mobileAppCategories",
-                self.token,
-                "",
-                data,
-                status_code=201,
-            )
-            created_categories.append(request)
+        results = self.graph_batch(
+            [
+                {
+                    "method": "POST",
+                    "url": f"{GRAPH_URL}/beta/deviceAppManagement/mobileAppCategories",
+                    "body": {"displayName": category},
+                }
+                for category in categories
+            ],
+            status_codes=[201],
+        )
+        created_categories = [result["body"] for result in results]
+
+        catalog_file = self.get_category_catalog_file()
+        with _category_catalogs_lock:
+            catalog = _category_catalogs.get(self.TENANT_ID)
+            if catalog is not None:
+                for category in created_categories:
+                    catalog["categories"][category["displayName"]] = category["id"]
+                self.save_category_catalog(catalog_file, catalog)
 
         return created_categories
 
     def get_current_app(self, displayname: str, version: int, odata_type: str) -> tuple:
         """Gets the current app from Intune.
 
+        The app is looked up in the local app inventory, which can be stale. Unless the
+        app is found to be current or the inventory was synced in this run, the lookup is
+        confirmed with Intune before the app is created or updated, in case it was
+        created or deleted elsewhere.
+
         Args:
             displayname (str): The display name of the app.
             version (int): The version of the app.
@@ -513,80 +409,105 @@ class IntuneUploaderBase(Processor):
             tuple: The result of the request and the data returned by the request.
         """
 
-        matching_apps = self.get_matching_apps(displayname)
-        request = [
-            app
-            for app in matching_apps
-            if app["displayName"] == displayname
-            and app.get("primaryBundleVersion") == version
-            or app.get("buildNumber") == version
-            and app["@odata.type"] == odata_type
+        fields = [
+            "id",
+            "displayName",
+            "primaryBundleVersion",
+            "buildNumber",
+            "committedContentVersion",
+            "categories",
         ]
-        result = None
-        data = {}
-
-        if request:
-            for item in request:
-                item_version = (
-                    item.get("primaryBundleVersion")
-                    if item.get("primaryBundleVersion")
-                    else item.get("buildNumber")
-                )
-                if item_version < version:
-                    result = "update"
-                    item["primaryBundleVersion"] = item_version
-                    data = item
-                else:
-                    result = "current"
-                    item["primaryBundleVersion"] = item_version
-                    data = item
+        matching_apps = self.get_matching_apps(displayname, fields=fields)
+        result, data = self.match_current_app(
+            matching_apps, displayname, version, odata_type
+        )
+        if (
+            result != "current"
+            and self.get_app_inventory_ttl()
+            and not getattr(self, "app_inventory_synced", False)
+        ):
+            matching_apps = self.get_matching_apps(
+                displayname, refresh=True, fields=fields
+            )
+            result, data = self.match_current_app(
+                matching_apps, displayname, version, odata_type
+            )
 
         return result, data
 
     def update_categories(self, category_names: list, current_categories: list) -> None:
         """Gets the category IDs for the specified category name(s).
 
+        If adding the categories fails, for example because a cached category ID is
+        stale, the category catalog is fetched again and the categories are added once
+        more before giving up.
+
         Args:
             category_names (list): The category name(s).
             current_categories (list): The current categories for the app.
         """
-        # Define the URL to retrieve the mobile app categories
+        # Define the URL of the mobile app categories
         category_url = (
             "https://graph.microsoft.com/v1.0/deviceAppManagement/mobileAppCategories"
         )
 
-        # Retrieve the list of mobile app categories
-        categories = self.makeapirequest(category_url, self.token, "")
-
-        # If there are current categories, get their display names
-        if current_categories:
-            current_categories = [c["displayName"] for c in current_categories]
-            # Filter the category IDs to only include those with display names in the category_names list and not in the current_categories list
-            category_ids = [
-                c
-                for c in categories["value"]
-                if c["displayName"] in category_names
-                and c["displayName"] not in current_categories
-            ]
-        # If there are no current categories, filter the category IDs to only include those with display names in the category_names list
-        else:
-            category_ids = [
-                c for c in categories["value"] if c["displayName"] in category_names
+        for attempt in range(2):
+            # Get the mobile app categories from the catalog
+            categories = [
+                {"displayName": name, "id": category_id}
+                for name, category_id in self.get_category_catalog(
+                    category_names
+                ).items()
             ]
 
-        # If there are category IDs to add, add them to the app
-        if category_ids:
-            for category_id in category_ids:
-                # Create the data payload to add the category to the app
-                data = json.dumps({"@odata.id": f'{category_url}/{category_id["id"]}'})
-                # Make the API request to add the category to the app
-                self.makeapirequestPost(
-                    f'{self.BASE_ENDPOINT}/{self.request["id"]}/categories/$ref',
-                    self.token,
-                    "",
-                    data,
-                    204,
+            # If there are current categories, get their display names
+            if current_categories:
+                current_names = [c["displayName"] for c in current_categories]
+                # Filter the category IDs to only include those with display names in the category_names list and not in the current_categories list
+                category_ids = [
+                    c
+                    for c in categories
+                    if c["displayName"] in category_names
+                    and c["displayName"] not in current_names
+                ]
+            # If there are no current categories, filter the category IDs to only include those with display names in the category_names list
+            else:
+                category_ids = [
+                    c for c in categories if c["displayName"] in category_names
+                ]
+
+            # If there are no category IDs to add, the app is up to date
+            if not category_ids:
+                return
+
+            # Add the categories to the app in batches
+            try:
+                self.graph_batch(
+                    [
+                        {
+                            "method": "POST",
+                            "url": f'{self.BASE_ENDPOINT}/{self.request["id"]}/categories/$ref',
+                            "body": {
+                                "@odata.id": f'{category_url}/{category_id["id"]}'
+                            },
+                        }
+                        for category_id in category_ids
+                    ],
+                    status_codes=[204],
                 )
+                return
+            except ProcessorError:
+                # A category may have been deleted since the catalog was cached
+                self.invalidate_category_catalog()
+                if attempt:
+                    raise
+                self.output(
+                    "Failed to add categories, refreshing the category catalog and trying again"
+                )
+                # Some of the categories may have been added before the failure
+                current_categories = self.makeapirequest(
+                    f'{self.BASE_ENDPOINT}/{self.request["id"]}/categories', self.token
+                )["value"]
 
     def encode_icon(self, icon_path: str) -> str:
         """Encodes an icon file as a base64 string.
@@ -607,19 +528,21 @@ class IntuneUploaderBase(Processor):
             app (class): The app class.
             assignment_info (dict): The assignment information.
         """
-        current_assignment = self.makeapirequest(
-            f"{self.BASE_ENDPOINT}/{self.request['id']}/assignments", self.token
+        current_assignment = list(
+            self.iter_graph_items(
+                f"{self.BASE_ENDPOINT}/{self.request['id']}/assignments"
+            )
         )
         # Get the current group ids
         current_group_ids = [
             c["target"].get("groupId")
-            for c in current_assignment["value"]
+            for c in current_assignment
             if c["target"].get("groupId")
         ]
         # Get the current all assignments
         current_all_assignment = [
             c["target"].get("@odata.type")
-            for c in current_assignment["value"]
+            for c in current_assignment
             if c["target"]["@odata.type"] != "#microsoft.graph.groupAssignmentTarget"
         ]
 
@@ -681,7 +604,7 @@ class IntuneUploaderBase(Processor):
                     }
                 )
 
-        for assignment in current_assignment["value"]:
+        for assignment in current_assignment:
             data["mobileAppAssignments"].append(
                 {
                     "@odata.type": "#microsoft.graph.mobileAppAssignment",
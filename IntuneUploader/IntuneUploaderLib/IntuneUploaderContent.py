@@ -0,0 +1,724 @@
+#!/usr/local/autopkg/python
+# -*- coding: utf-8 -*-
+
+"""
+IntuneUploaderContent encrypts app content files and uploads them to Intune.
+"""
+
+import base64
+import glob
+import hashlib
+import hmac
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from datetime import datetime, timedelta, timezone
+from xml.etree import ElementTree
+
+import requests
+from autopkglib import ProcessorError
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+__all__ = ["ContentMixin"]
+
+# Number of bytes read from the app at a time when encrypting
+ENCRYPTION_CHUNK_SIZE = 4 * 1024 * 1024
+# Minimum and maximum seconds between polls of the file content status
+POLL_INTERVAL_MIN = 0.5
+POLL_INTERVAL_MAX = 10
+# Default seconds to wait for an Azure Storage upload URL
+AZURE_STORAGE_URI_TIMEOUT = 300
+# Default seconds to wait for a commit, plus seconds per GB of the app
+COMMIT_TIMEOUT = 120
+COMMIT_TIMEOUT_PER_GB = 120
+# Name of the file in the recipe cache directory that holds the upload state of a tenant
+UPLOAD_STATE_FILE = "intuneappuploader_upload_state_{tenant_id}.json"
+# Name of the ledger in the cache directory recording the app files uploaded to Intune
+UPLOAD_LEDGER_FILE = "upload_ledger.sqlite"
+# SHA-256 digests of app files hashed in this run, keyed by path, size and mtime
+_app_file_digests = {}
+_app_file_digests_lock = threading.Lock()
+
+
+class ContentMixin:
+    """Encrypts, uploads and commits app content files."""
+
+    def encrypt_app_to_file(
+        self,
+        encrypted_app_file: str,
+        chunk_size: int = ENCRYPTION_CHUNK_SIZE,
+        cancelled: threading.Event = None,
+    ) -> dict:
+        """Encrypts the app with AES-256 in CBC mode and streams the result to a file.
+
+        The app is read once in chunks of chunk_size bytes. Padding, encryption, the
+        HMAC and the file digest are all fed incrementally, so memory use is bounded
+        by the chunk size rather than the app size. The file written has the layout
+        Intune expects: signature + IV + encrypted data.
+
+        Args:
+            encrypted_app_file (str): The path to write the encrypted app to.
+            chunk_size (int, optional): The number of bytes to read at a time.
+                Defaults to ENCRYPTION_CHUNK_SIZE.
+            cancelled (threading.Event, optional): Stops the encryption once set.
+                Defaults to None.
+
+        Returns:
+            dict: The encryption info.
+
+        Raises:
+            ProcessorError: If the encryption was cancelled or the runtime budget is spent.
+        """
+        encryptionKey = os.urandom(32)
+        hmacKey = os.urandom(32)
+        initializationVector = os.urandom(16)
+
+        padder = padding.PKCS7(128).padder()
+        cipher = Cipher(algorithms.AES(encryptionKey), modes.CBC(initializationVector))
+        encryptor = cipher.encryptor()
+        # The HMAC covers the IV and the encrypted data
+        h = hmac.new(hmacKey, initializationVector, hashlib.sha256)
+        filehash_sha256 = hashlib.sha256()
+
+        with open(self.app_file, "rb") as src, open(encrypted_app_file, "wb") as dst:
+            # Reserve room for the signature, it is written once the HMAC is known
+            dst.write(b"\0" * h.digest_size)
+            dst.write(initializationVector)
+
+            while True:
+                if cancelled is not None and cancelled.is_set():
+                    raise ProcessorError("Encryption cancelled, another phase failed")
+                self.check_deadline("encrypting the app")
+                chunk = src.read(chunk_size)
+                if not chunk:
+                    break
+                filehash_sha256.update(chunk)
+                encrypted_chunk = encryptor.update(padder.update(chunk))
+                h.update(encrypted_chunk)
+                dst.write(encrypted_chunk)
+                self.count_metric("bytes_read", len(chunk))
+                self.count_metric("bytes_encrypted", len(encrypted_chunk))
+
+            encrypted_chunk = encryptor.update(padder.finalize()) + encryptor.finalize()
+            h.update(encrypted_chunk)
+            dst.write(encrypted_chunk)
+            self.count_metric("bytes_encrypted", len(encrypted_chunk))
+
+            signature = h.digest()
+            dst.seek(0)
+            dst.write(signature)
+
+        return self.encryption_info(
+            encryptionKey,
+            hmacKey,
+            initializationVector,
+            signature,
+            filehash_sha256.digest(),
+        )
+
+    def encryption_info(
+        self,
+        encryptionKey: bytes,
+        hmacKey: bytes,
+        initializationVector: bytes,
+        signature: bytes,
+        fileDigest: bytes,
+    ) -> dict:
+        """Creates the file encryption info dictionary for the Microsoft Graph API.
+
+        Args:
+            encryptionKey (bytes): The AES encryption key.
+            hmacKey (bytes): The HMAC key.
+            initializationVector (bytes): The AES initialization vector.
+            signature (bytes): The HMAC-SHA256 signature of the IV and encrypted data.
+            fileDigest (bytes): The SHA-256 digest of the unencrypted app.
+
+        Returns:
+            dict: The file encryption info.
+        """
+        fileEncryptionInfo = {}
+        fileEncryptionInfo["@odata.type"] = "#microsoft.graph.fileEncryptionInfo"
+        fileEncryptionInfo["encryptionKey"] = base64.b64encode(encryptionKey).decode()
+        fileEncryptionInfo["macKey"] = base64.b64encode(hmacKey).decode()
+        fileEncryptionInfo["initializationVector"] = base64.b64encode(
+            initializationVector
+        ).decode()
+        fileEncryptionInfo["profileIdentifier"] = "ProfileVersion1"
+        fileEncryptionInfo["fileDigestAlgorithm"] = "SHA256"
+        fileEncryptionInfo["fileDigest"] = base64.b64encode(fileDigest).decode()
+        fileEncryptionInfo["mac"] = base64.b64encode(signature).decode()
+
+        return fileEncryptionInfo
+
+    def wait_for_upload_state(
+        self,
+        success_state: str,
+        failed_state: str,
+        timeout: float,
+        description: str,
+        delete_on_failure: bool = True,
+    ) -> dict:
+        """Polls the file content status until it reaches the success or failed state.
+
+        Polling starts at POLL_INTERVAL_MIN seconds and backs off exponentially to
+        POLL_INTERVAL_MAX seconds, waiting longer if Graph sends Retry-After. The time
+        spent in each upload state, up to the last state seen, is added to the
+        upload_states metrics of the run. Failures
+        and timeouts count towards a circuit breaker per operation, so later uploads fail
+        fast instead of waiting for the full timeout while Graph is degraded. The timeout
+        is shortened to the remaining runtime budget of the processor.
+
+        Args:
+            success_state (str): The upload state to wait for.
+            failed_state (str): The upload state that means the operation failed.
+            timeout (float): The number of seconds to wait before giving up.
+            description (str): A description of what is being waited for, used in errors.
+            delete_on_failure (bool, optional): Whether to delete the app if the operation
+                fails or times out. Defaults to True.
+
+        Returns:
+            dict: The file content status dictionary.
+
+        Raises:
+            ProcessorError: If the operation fails or times out, or the circuit breaker is open.
+        """
+        url = f"{self.BASE_ENDPOINT}/{self.request['id']}/microsoft.graph.macOSLobApp/contentVersions/{self.content_version_request['id']}/files/{self.content_file_request['id']}"
+        circuit = f"uploadState/{success_state.replace('Success', '')}"
+        try:
+            self.check_circuit(circuit)
+        except ProcessorError:
+            if delete_on_failure:
+                self.delete_app()
+            raise
+        remaining = self.get_remaining_time()
+        budget_limited = remaining is not None and remaining < timeout
+        if budget_limited:
+            timeout = max(remaining, 0)
+        start_time = time.monotonic()
+        state_start_time = start_time
+        previous_state = None
+        interval = POLL_INTERVAL_MIN
+
+        def record_state(state, seconds):
+            self.output(
+                f"Upload state {state} took {seconds:.1f} seconds", verbose_level=2
+            )
+            if getattr(self, "metrics", None) is not None:
+                with self.metrics_lock:
+                    states = self.metrics["upload_states"]
+                    states[state] = states.get(state, 0) + seconds
+
+        while True:
+            response = self.make_graph_request("GET", url, self.token)
+            if response.status_code != 200:
+                raise ProcessorError(
+                    "Request failed with ", response.status_code, " - ", response.text
+                )
+            status = json.loads(response.text)
+            state = status["uploadState"]
+            now = time.monotonic()
+
+            # Record how long the previous state lasted
+            if state != previous_state:
+                if previous_state is not None:
+                    record_state(previous_state, now - state_start_time)
+                previous_state, state_start_time = state, now
+
+            # The last state seen lasted until polling stops
+            if state in (success_state, failed_state) or now - start_time >= timeout:
+                record_state(state, now - state_start_time)
+
+            if state == success_state:
+                self.record_circuit(circuit, True)
+                self.output(
+                    f"Reached upload state {state} after {now - start_time:.1f} seconds",
+                    verbose_level=2,
+                )
+                return status
+            if state == failed_state:
+                self.record_circuit(circuit, False)
+                if delete_on_failure:
+                    self.delete_app()
+                raise ProcessorError(f"Failed to {description}")
+            if now - start_time >= timeout:
+                if delete_on_failure:
+                    self.delete_app()
+                if budget_limited:
+                    self.check_deadline(f"waiting to {description}")
+                self.record_circuit(circuit, False)
+                raise ProcessorError(
+                    f"Timed out after {timeout:.0f} seconds waiting to {description}"
+                )
+
+            # Wait longer if Graph asks for it, but not past the deadline
+            delay = interval
+            if response.headers.get("Retry-After"):
+                delay = max(delay, self.retry_delay(response.headers, 1))
+            time.sleep(min(delay, max(timeout - (now - start_time), 0)))
+            interval = min(interval * 2, POLL_INTERVAL_MAX)
+
+    def get_uncommitted_blocks(self, azure_storage_uri: str) -> dict:
+        """Gets the uncommitted blocks of a blob in Azure Blob Storage.
+
+        Args:
+            azure_storage_uri (str): The URI of the Azure Blob Storage blob.
+
+        Returns:
+            dict: The uncommitted block IDs mapped to their size in bytes.
+        """
+        uri = f"{azure_storage_uri}&comp=blocklist&blocklisttype=uncommitted"
+        try:
+            r = self.http_request("GET", uri)
+        except requests.exceptions.RequestException:
+            return {}
+        if r.status_code != 200:
+            return {}
+
+        blocks = {}
+        for block in ElementTree.fromstring(r.content).iter("Block"):
+            blocks[block.findtext("Name")] = int(block.findtext("Size"))
+
+        return blocks
+
+    def save_upload_state(self, upload_state: dict) -> None:
+        """Persists the upload state to the recipe cache directory.
+
+        Args:
+            upload_state (dict): The upload state.
+        """
+        state_file = self.get_upload_state_file()
+        # Write to a temporary file first so the state file is never left half written
+        fd = os.open(f"{state_file}.tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(upload_state, f)
+        os.replace(f"{state_file}.tmp", state_file)
+
+    def discard_upload_state(self, upload_state: dict) -> None:
+        """Removes the persisted upload state and the encrypted file it refers to.
+
+        Args:
+            upload_state (dict): The upload state.
+        """
+        state_file = self.get_upload_state_file()
+        if os.path.exists(state_file):
+            os.unlink(state_file)
+        if upload_state.get("encrypted_file"):
+            self.remove_unreferenced_file(upload_state["encrypted_file"])
+
+    def resume_upload(self, current_app: dict) -> dict:
+        """Checks if an interrupted upload of the current app can be resumed.
+
+        If it can, the app, content version and content file requests are restored
+        from the persisted upload state. Stale upload state is discarded.
+
+        Args:
+            current_app (dict): The current app in Intune.
+
+        Returns:
+            dict: The upload state if the upload can be resumed, otherwise an empty dict.
+        """
+        state_file = self.get_upload_state_file()
+        if not os.path.exists(state_file):
+            return {}
+
+        try:
+            with open(state_file, "r", encoding="utf-8") as f:
+                upload_state = json.load(f)
+        except (OSError, ValueError):
+            os.unlink(state_file)
+            return {}
+
+        # The state is only valid for the same app and the same, unchanged app file
+        if (
+            upload_state.get("app_id") != current_app.get("id")
+            or upload_state.get("app_file") != self.app_file
+            or upload_state.get("app_file_size") != os.path.getsize(self.app_file)
+            or upload_state.get("app_file_mtime") != os.path.getmtime(self.app_file)
+            or not os.path.exists(upload_state.get("encrypted_file", ""))
+        ):
+            self.output("Discarding upload state of a previous run")
+            self.discard_upload_state(upload_state)
+            return {}
+
+        self.request = current_app
+        self.content_update = upload_state["content_update"]
+        self.content_version_request = {"id": upload_state["content_version_id"]}
+        self.content_file_request = {"id": upload_state["content_file_id"]}
+
+        # The content file must still be waiting for its upload
+        try:
+            status = self.get_file_content_status()
+        except ProcessorError:
+            status = {}
+        if status.get("uploadState") not in (
+            "azureStorageUriRequestSuccess",
+            "azureStorageUriRenewalSuccess",
+        ):
+            self.output("Upload of a previous run can not be resumed, starting over")
+            self.discard_upload_state(upload_state)
+            return {}
+
+        # Renew the upload URL if it has expired
+        expiration = status.get("azureStorageUriExpirationDateTime")
+        if expiration and datetime.strptime(
+            expiration[:19], "%Y-%m-%dT%H:%M:%S"
+        ) <= datetime.utcnow() + timedelta(minutes=5):
+            self.output("Azure Storage upload URL has expired, renewing it")
+            status = self.renew_azure_storage_uri()
+
+        upload_state["azure_storage_uri"] = status.get(
+            "azureStorageUri", upload_state["azure_storage_uri"]
+        )
+        self.save_upload_state(upload_state)
+
+        return upload_state
+
+    def renew_azure_storage_uri(self) -> dict:
+        """Renews the Azure Storage upload URL of a content file.
+
+        Returns:
+            dict: The file content status dictionary.
+
+        Raises:
+            ProcessorError: If the renewal fails or times out.
+        """
+        self.makeapirequestPost(
+            f"{self.BASE_ENDPOINT}/{self.request['id']}/microsoft.graph.macOSLobApp/contentVersions/{self.content_version_request['id']}/files/{self.content_file_request['id']}/renewUpload",
+            self.token,
+            "",
+            json.dumps({}),
+            204,
+        )
+        return self.wait_for_upload_state(
+            "azureStorageUriRenewalSuccess",
+            "azureStorageUriRenewalFailed",
+            float(
+                self.env.get("AZURE_STORAGE_URI_TIMEOUT") or AZURE_STORAGE_URI_TIMEOUT
+            ),
+            "renew the Azure Storage upload URL",
+            delete_on_failure=False,
+        )
+
+    def get_block_id(self, block_index: int) -> str:
+        """Gets the Azure Blob Storage block ID for a block index.
+
+        Args:
+            block_index (int): The index of the block in the blob.
+
+        Returns:
+            str: The base64 encoded block ID.
+        """
+        return base64.b64encode(f"block-{block_index:04}".encode()).decode()
+
+    def put_block(self, azure_storage_uri: str, block_id: str, data: bytes) -> None:
+        """Uploads a block to Azure Blob Storage.
+
+        Args:
+            azure_storage_uri (str): The URI of the Azure Blob Storage blob.
+            block_id (str): The ID of the block.
+            data (bytes): The data of the block.
+
+        Raises:
+            ProcessorError: If the block could not be uploaded.
+        """
+        uri = f"{azure_storage_uri}&comp=block&blockid={block_id}"
+        headers = {"x-ms-blob-type": "BlockBlob"}
+        self.check_deadline(f"uploading block {block_id}")
+        try:
+            r = self.http_request("PUT", uri, headers=headers, data=data)
+        except requests.exceptions.RequestException as e:
+            raise ProcessorError(f"Failed to upload block {block_id}: {e}") from e
+        if r.status_code != 201:
+            raise ProcessorError(
+                f"Failed to upload block {block_id}. Status code: {r.status_code}"
+            )
+        self.count_metric("bytes_uploaded", len(data))
+
+    def put_block_list(self, azure_storage_uri: str, block_ids: list) -> None:
+        """Commits the blocks of a blob in Azure Blob Storage in the given order.
+
+        Args:
+            azure_storage_uri (str): The URI of the Azure Blob Storage blob.
+            block_ids (list): The IDs of the blocks in the order they make up the blob.
+
+        Raises:
+            ProcessorError: If the block list could not be uploaded.
+        """
+        # Generate the block list XML
+        block_list_xml = "<BlockList>"
+        for block_id in block_ids:
+            block_list_xml += f"<Latest>{block_id}</Latest>"
+        block_list_xml += "</BlockList>"
+
+        # Upload the block list XML
+        uri = f"{azure_storage_uri}&comp=blocklist"
+        headers = {"Content-Type": "application/xml"}
+        r = self.http_request("PUT", uri, headers=headers, data=block_list_xml)
+
+        if r.status_code != 201:
+            raise ProcessorError("Failed to upload block list XML")
+
+    def upload_encrypted_app(
+        self,
+        azure_storage_uri: str,
+        concurrency: int = 1,
+        chunk_size: int = 6 * 1024 * 1024,
+    ) -> dict:
+        """Encrypts the app with AES-256 in CBC mode and uploads it to Azure Blob Storage in one pass.
+
+        Each encrypted chunk is uploaded as a block while the next chunk is encrypted,
+        so no temporary file is written. The signature and IV make up the first block
+        of the blob, it is uploaded last once the HMAC is known. At most concurrency + 1
+        blocks are held in memory.
+
+        Args:
+            azure_storage_uri (str): The URI of the Azure Blob Storage blob.
+            concurrency (int, optional): The number of blocks to upload at the same time. Defaults to 1.
+            chunk_size (int, optional): The number of bytes to read at a time. Defaults to 6 MB.
+
+        Returns:
+            dict: The encryption info.
+        """
+        concurrency = max(1, int(concurrency))
+        encryptionKey = os.urandom(32)
+        hmacKey = os.urandom(32)
+        initializationVector = os.urandom(16)
+
+        padder = padding.PKCS7(128).padder()
+        cipher = Cipher(algorithms.AES(encryptionKey), modes.CBC(initializationVector))
+        encryptor = cipher.encryptor()
+        # The HMAC covers the IV and the encrypted data
+        h = hmac.new(hmacKey, initializationVector, hashlib.sha256)
+        filehash_sha256 = hashlib.sha256()
+
+        # The first block holds the signature and IV
+        block_ids = [self.get_block_id(0)]
+        in_flight = threading.Semaphore(concurrency + 1)
+        errors = []
+
+        def _upload_block(block_id: str, data: bytes) -> int:
+            try:
+                self.put_block(azure_storage_uri, block_id, data)
+            except Exception as e:
+                errors.append(e)
+                raise
+            finally:
+                in_flight.release()
+            return len(data)
+
+        start_time = time.monotonic()
+        futures = []
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        try:
+            with open(self.app_file, "rb") as src:
+                while True:
+                    self.check_deadline("encrypting and uploading the app")
+                    chunk = src.read(chunk_size)
+                    if chunk:
+                        filehash_sha256.update(chunk)
+                        encrypted_chunk = encryptor.update(padder.update(chunk))
+                        self.count_metric("bytes_read", len(chunk))
+                    else:
+                        encrypted_chunk = (
+                            encryptor.update(padder.finalize()) + encryptor.finalize()
+                        )
+                    h.update(encrypted_chunk)
+                    self.count_metric("bytes_encrypted", len(encrypted_chunk))
+
+                    if encrypted_chunk:
+                        # Wait for a free slot so memory stays bounded, stop if an upload failed
+                        in_flight.acquire()
+                        if errors:
+                            raise errors[0]
+                        block_ids.append(self.get_block_id(len(block_ids)))
+                        futures.append(
+                            executor.submit(
+                                _upload_block, block_ids[-1], encrypted_chunk
+                            )
+                        )
+                    if not chunk:
+                        break
+
+            signature = h.digest()
+            in_flight.acquire()
+            futures.append(
+                executor.submit(
+                    _upload_block, block_ids[0], signature + initializationVector
+                )
+            )
+            uploaded_bytes = sum(future.result() for future in futures)
+        finally:
+            executor.shutdown(cancel_futures=True)
+        elapsed = max(time.monotonic() - start_time, 0.001)
+
+        self.output(
+            f"Encrypted and uploaded {len(block_ids)} blocks ({uploaded_bytes / 1048576:.1f} MB) in {elapsed:.1f} seconds "
+            f"({uploaded_bytes / 1048576 / elapsed:.1f} MB/s) using {concurrency} worker(s)"
+        )
+
+        self.put_block_list(azure_storage_uri, block_ids)
+
+        return self.encryption_info(
+            encryptionKey,
+            hmacKey,
+            initializationVector,
+            signature,
+            filehash_sha256.digest(),
+        )
+
+    def get_upload_state_file(self) -> str:
+        """Returns the path of the upload state file of the current tenant.
+
+        Returns:
+            str: The path of the upload state file.
+        """
+        return os.path.join(
+            self.RECIPE_CACHE_DIR, UPLOAD_STATE_FILE.format(tenant_id=self.TENANT_ID)
+        )
+
+    def remove_unreferenced_file(self, encrypted_file: str) -> None:
+        """Removes an encrypted file unless it is still in use.
+
+        The encrypted file can be shared by the uploads to several tenants, it is kept
+        while it is used by this run or referenced by the upload state of a tenant.
+
+        Args:
+            encrypted_file (str): The path of the encrypted file.
+        """
+        if encrypted_file in getattr(self, "encrypted_files_in_use", ()):
+            return
+
+        state_files = glob.glob(
+            os.path.join(self.RECIPE_CACHE_DIR, UPLOAD_STATE_FILE.format(tenant_id="*"))
+        )
+        for state_file in state_files:
+            try:
+                with open(state_file, "r", encoding="utf-8") as f:
+                    if json.load(f).get("encrypted_file") == encrypted_file:
+                        return
+            except (OSError, ValueError):
+                continue
+
+        if os.path.exists(encrypted_file):
+            os.unlink(encrypted_file)
+
+    def get_app_file_sha256(self) -> str:
+        """Calculates the SHA-256 digest of the app file.
+
+        The digest is calculated at most once per run for each version of the file, so
+        uploads of the same file to several tenants share it.
+
+        Returns:
+            str: The hex digest of the app file.
+        """
+        stat = os.stat(self.app_file)
+        key = (os.path.realpath(self.app_file), stat.st_size, stat.st_mtime)
+        with _app_file_digests_lock:
+            if key not in _app_file_digests:
+                file_hash = hashlib.sha256()
+                with open(self.app_file, "rb") as f:
+                    for chunk in iter(lambda: f.read(ENCRYPTION_CHUNK_SIZE), b""):
+                        self.check_deadline("hashing the app")
+                        file_hash.update(chunk)
+                        self.count_metric("bytes_read", len(chunk))
+                _app_file_digests[key] = file_hash.hexdigest()
+
+            return _app_file_digests[key]
+
+    def get_encryption_info_sha256(self, encryption_info: dict) -> str:
+        """Gets the SHA-256 digest of the app file calculated while it was encrypted.
+
+        Args:
+            encryption_info (dict): The file encryption info.
+
+        Returns:
+            str: The hex digest of the app file.
+        """
+        return base64.b64decode(encryption_info["fileDigest"]).hex()
+
+    def open_upload_ledger(self) -> sqlite3.Connection:
+        """Opens the upload ledger in the cache directory.
+
+        The ledger records which app file, by SHA-256 digest, was committed as which
+        content version of an app in each tenant, and the digest of the icon last sent
+        for each app.
+
+        Returns:
+            sqlite3.Connection: A connection to the ledger.
+        """
+        conn = sqlite3.connect(
+            os.path.join(self.get_cache_dir(), UPLOAD_LEDGER_FILE), timeout=60
+        )
+        conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS uploads (
+                sha256 TEXT,
+                tenant_id TEXT,
+                app_id TEXT,
+                content_version_id TEXT,
+                committed_at TEXT,
+                PRIMARY KEY (sha256, tenant_id, app_id)
+            );
+            CREATE TABLE IF NOT EXISTS icons (
+                tenant_id TEXT,
+                app_id TEXT,
+                sha256 TEXT,
+                PRIMARY KEY (tenant_id, app_id)
+            );
+            """
+        )
+        return conn
+
+    def get_uploaded_content_version(self, app: dict):
+        """Gets the content version of an app that already holds the app file.
+
+        The ledger entry only counts if the recorded content version is still the
+        committed content version of the app. The app file is only hashed if the
+        ledger has an entry for that content version.
+
+        Args:
+            app (dict): The app in Intune.
+
+        Returns:
+            str: The ID of the content version, or None if the app file has to be uploaded.
+        """
+        if not app.get("id") or not app.get("committedContentVersion"):
+            return None
+
+        with closing(self.open_upload_ledger()) as conn:
+            digests = [
+                row[0]
+                for row in conn.execute(
+                    "SELECT sha256 FROM uploads WHERE tenant_id = ? AND app_id = ? AND content_version_id = ?",
+                    (self.TENANT_ID, app["id"], app["committedContentVersion"]),
+                )
+            ]
+
+        if digests and self.get_app_file_sha256() in digests:
+            return app["committedContentVersion"]
+
+        return None
+
+    def record_upload(self, sha256: str) -> None:
+        """Records the committed content version of the current app in the upload ledger.
+
+        Args:
+            sha256 (str): The SHA-256 digest of the app file.
+        """
+        with closing(self.open_upload_ledger()) as conn:
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?)",
+                    (
+                        sha256,
+                        self.TENANT_ID,
+                        self.request["id"],
+                        self.content_version_request["id"],
+                        datetime.now(timezone.utc).isoformat(),
+                    ),
+                )
@@ -0,0 +1,303 @@
+#!/usr/local/autopkg/python
+# -*- coding: utf-8 -*-
+
+"""
+IntuneUploaderDaemon is an optional local worker that keeps Graph state warm between processor runs.
+
+It listens on a Unix domain socket in the IntuneUploader cache directory and holds pooled
+HTTP sessions with open TLS connections to Graph, the identity platform and Azure Storage,
+as well as the access tokens of the tenants it served. Processors based on
+IntuneUploaderBase send their requests through it when it is running and make them
+directly when it is not. The category catalog, app inventory and rate limiter are shared
+through the cache directory already and are used the same way with or without the daemon.
+
+Start it with the AutoPkg Python before running recipes, for example:
+
+    /usr/local/autopkg/python IntuneUploaderDaemon.py --idle-timeout 3600
+"""
+
+import argparse
+import base64
+import errno
+import json
+import os
+import plistlib
+import socket
+import socketserver
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+__all__ = ["IntuneUploaderDaemon"]
+
+# Name of the daemon socket in the IntuneUploader cache directory
+DAEMON_SOCKET_FILE = "daemon.sock"
+# AutoPkg preferences holding the CACHE_DIR used by recipe runs
+AUTOPKG_PREFERENCES_FILE = "~/Library/Preferences/com.github.autopkg.plist"
+# Cache directory AutoPkg uses when CACHE_DIR is not set
+AUTOPKG_CACHE_DIR = "~/Library/AutoPkg/Cache"
+# Default number of pooled connections per host
+HTTP_POOL_SIZE = 10
+# Default seconds without requests after which the daemon exits, 0 to run until stopped
+IDLE_TIMEOUT = 3600
+
+
+class IntuneUploaderDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serves Graph requests and cached tokens to processors over a Unix domain socket.
+
+    Each connection carries one JSON request line and gets one JSON response line.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        socket_path: str,
+        pool_size: int = HTTP_POOL_SIZE,
+        idle_timeout: float = IDLE_TIMEOUT,
+    ):
+        """Binds the daemon to its socket, only the current user can connect to it.
+
+        Args:
+            socket_path (str): The path of the Unix domain socket.
+            pool_size (int, optional): The number of pooled connections per host.
+                Defaults to HTTP_POOL_SIZE.
+            idle_timeout (float, optional): The seconds without requests after which the
+                daemon exits, 0 to run until stopped. Defaults to IDLE_TIMEOUT.
+
+        Raises:
+            OSError: If another daemon is listening on the socket.
+        """
+        self.socket_path = socket_path
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.shutting_down = False
+        self.sessions = {}
+        self.sessions_lock = threading.Lock()
+        self.tokens = {}
+        self.tokens_lock = threading.Lock()
+        self.last_request = time.monotonic()
+
+        # Remove the socket of a daemon that did not shut down cleanly, but not the
+        # socket of one that is running
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(socket_path)
+            except ConnectionRefusedError:
+                os.remove(socket_path)
+            except FileNotFoundError:
+                pass
+            else:
+                raise OSError(
+                    errno.EADDRINUSE, f"A daemon is already listening on {socket_path}"
+                )
+        old_umask = os.umask(0o177)
+        try:
+            super().__init__(socket_path, DaemonRequestHandler)
+        finally:
+            os.umask(old_umask)
+        self.socket_inode = os.stat(socket_path).st_ino
+
+    def get_session(self, url: str) -> requests.Session:
+        """Gets the pooled HTTP session for the host of a URL.
+
+        Args:
+            url (str): The URL the session will be used for.
+
+        Returns:
+            requests.Session: The session for the host.
+        """
+        host = urlparse(url).netloc
+        with self.sessions_lock:
+            session = self.sessions.get(host)
+            if session is None:
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session = requests.Session()
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self.sessions[host] = session
+
+        return session
+
+    def handle_http_request(self, request: dict) -> dict:
+        """Makes an HTTP request using the pooled session for the host.
+
+        Args:
+            request (dict): The method, url, headers, params, data and timeout of the request.
+
+        Returns:
+            dict: The status code, headers, encoding and base64 encoded content of the
+                response, or the type and message of the error if no response was received.
+                The type is ConnectError if the connection could not be established.
+        """
+        timeout = request.get("timeout")
+        try:
+            response = self.get_session(request["url"]).request(
+                request["method"],
+                request["url"],
+                headers=request.get("headers"),
+                params=request.get("params"),
+                data=request.get("data"),
+                timeout=tuple(timeout) if isinstance(timeout, list) else timeout,
+            )
+        except requests.exceptions.ConnectTimeout as e:
+            return {"error": "ConnectError", "message": str(e)}
+        except requests.exceptions.Timeout as e:
+            return {"error": "Timeout", "message": str(e)}
+        except requests.exceptions.RequestException as e:
+            # Failures to connect are reported apart, the request was not sent then
+            reason = getattr(e.args[0], "reason", None) if e.args else None
+            if isinstance(reason, urllib3.exceptions.NewConnectionError):
+                return {"error": "ConnectError", "message": str(e)}
+            return {"error": "ConnectionError", "message": str(e)}
+
+        return {
+            "status_code": response.status_code,
+            "headers": dict(response.headers),
+            "encoding": response.encoding,
+            "content": base64.b64encode(response.content).decode(),
+        }
+
+    def handle_token_request(self, request: dict) -> dict:
+        """Gets or stores a cached access token.
+
+        Tokens are keyed by a digest of the tenant, client ID and client secret, so
+        only callers holding the same credentials get them back.
+
+        Args:
+            request (dict): The key and, to store it, the token.
+
+        Returns:
+            dict: The cached token, None if there is none or it expired.
+        """
+        with self.tokens_lock:
+            if request.get("token"):
+                self.tokens[request["key"]] = request["token"]
+            token = self.tokens.get(request["key"])
+            if token and token.get("expires_at", 0) <= time.time():
+                del self.tokens[request["key"]]
+                token = None
+
+        return {"token": token}
+
+    def service_actions(self):
+        """Shuts the daemon down once it was idle for the idle timeout."""
+        if (
+            self.idle_timeout
+            and not self.shutting_down
+            and time.monotonic() - self.last_request > self.idle_timeout
+        ):
+            # shutdown waits for serve_forever, so it is called from another thread
+            self.shutting_down = True
+            threading.Thread(target=self.shutdown).start()
+
+    def server_close(self):
+        """Closes the socket, removes it and closes the pooled sessions.
+
+        The socket file is only removed if it is still the one this daemon bound.
+        """
+        super().server_close()
+        try:
+            if os.stat(self.socket_path).st_ino == self.socket_inode:
+                os.remove(self.socket_path)
+        except FileNotFoundError:
+            pass
+        with self.sessions_lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions.clear()
+
+
+class DaemonRequestHandler(socketserver.StreamRequestHandler):
+    """Handles one JSON request line from a processor."""
+
+    def handle(self):
+        """Reads the request, runs it and writes the response."""
+        line = self.rfile.readline()
+        if not line:
+            # A connection without a request, for example from a daemon checking the socket
+            return
+        self.server.last_request = time.monotonic()
+        try:
+            request = json.loads(line)
+            if request.get("op") == "http_request":
+                response = self.server.handle_http_request(request)
+            elif request.get("op") == "token":
+                response = self.server.handle_token_request(request)
+            else:
+                response = {"error": "ValueError", "message": "Unknown operation"}
+        except (ValueError, KeyError) as e:
+            response = {"error": "ValueError", "message": str(e)}
+
+        self.wfile.write(json.dumps(response).encode() + b"\n")
+        self.server.last_request = time.monotonic()
+
+
+def get_default_socket_path() -> str:
+    """Gets the path of the daemon socket in the IntuneUploader cache directory.
+
+    The cache directory is IntuneUploader in the CACHE_DIR set in the AutoPkg
+    preferences, or in the default AutoPkg cache directory if it is not set.
+
+    Returns:
+        str: The socket path.
+    """
+    cache_dir = None
+    try:
+        with open(os.path.expanduser(AUTOPKG_PREFERENCES_FILE), "rb") as f:
+            cache_dir = plistlib.load(f).get("CACHE_DIR")
+    except (OSError, plistlib.InvalidFileException):
+        pass
+
+    cache_dir = os.path.join(
+        os.path.expanduser(cache_dir or AUTOPKG_CACHE_DIR), "IntuneUploader"
+    )
+    return os.path.join(cache_dir, DAEMON_SOCKET_FILE)
+
+
+def main():
+    """Runs the daemon until it is stopped or idle for the idle timeout."""
+    parser = argparse.ArgumentParser(
+        description=__doc__.split("\n\n", maxsplit=1)[0].strip()
+    )
+    parser.add_argument(
+        "--socket",
+        default=get_default_socket_path(),
+        help="The path of the Unix domain socket, it must be daemon.sock in the IntuneUploader "
+        "cache directory the recipes use. Defaults to that path for the CACHE_DIR in the "
+        "AutoPkg preferences.",
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=IDLE_TIMEOUT,
+        help="Seconds without requests after which the daemon exits, 0 to run until stopped.",
+    )
+    parser.add_argument(
+        "--pool-size",
+        type=int,
+        default=HTTP_POOL_SIZE,
+        help="The number of pooled connections per host.",
+    )
+    args = parser.parse_args()
+
+    os.makedirs(os.path.dirname(args.socket), mode=0o700, exist_ok=True)
+    try:
+        server = IntuneUploaderDaemon(args.socket, args.pool_size, args.idle_timeout)
+    except OSError as e:
+        parser.exit(1, f"{e}\n")
+    print(f"Listening on {args.socket}")
+    try:
+        server.serve_forever(poll_interval=1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+#!/usr/local/autopkg/python
+# -*- coding: utf-8 -*-
+
+"""
+IntuneUploaderGraph reads paged Graph collections and combines Graph requests into JSON batches.
+"""
+
+import json
+
+from autopkglib import ProcessorError
+
+from IntuneUploaderLib.IntuneUploaderHTTP import (
+    GRAPH_MAX_ATTEMPTS,
+    NOT_PROCESSED_STATUS_CODES,
+    RETRY_STATUS_CODES,
+)
+
+__all__ = ["GraphMixin"]
+
+# Graph API host and the maximum number of requests in a JSON batch
+GRAPH_URL = "https://graph.microsoft.com"
+GRAPH_BATCH_SIZE = 20
+
+
+class GraphMixin:
+    """Pages through Graph collections and sends Graph requests in batches."""
+
+    def iter_graph_pages(self, endpoint: str, token: dict, q_param=None):
+        """Makes a GET request to the Graph API and yields each page of the response.
+
+        Pages are requested one at a time by following @odata.nextLink, so the caller
+        can process a page before the next one is requested.
+
+        Args:
+            endpoint (str): The endpoint to make the request to.
+            token (dict): The access token to use for authenticating the request.
+            q_param (dict, optional): The query parameters to use for the first request. Defaults to None.
+
+        Yields:
+            dict: Each page of the response as a dictionary.
+        """
+        next_link = endpoint
+        while next_link:
+            response = self.make_graph_request("GET", next_link, token, q_param)
+            if response.status_code != 200:
+                raise ProcessorError(
+                    "Request failed with ", response.status_code, " - ", response.text
+                )
+            page = json.loads(response.text)
+            yield page
+
+            # The next link already contains the query parameters
+            next_link = page.get("@odata.nextLink")
+            q_param = None
+
+    def iter_graph_items(self, endpoint: str, params=None, page_size=None, token=None):
+        """Yields the items of a Graph API collection as pages arrive.
+
+        Args:
+            endpoint (str): The endpoint of the collection.
+            params (dict, optional): The query parameters to use for the request. Defaults to None.
+            page_size (int, optional): The number of items to request per page with $top.
+                Defaults to the GRAPH_PAGE_SIZE variable, if set.
+            token (dict, optional): The access token to use. Defaults to self.token.
+
+        Yields:
+            dict: Each item in the collection.
+        """
+        params = dict(params or {})
+        page_size = page_size or self.env.get("GRAPH_PAGE_SIZE")
+        if page_size:
+            params["$top"] = int(page_size)
+
+        for page in self.iter_graph_pages(endpoint, token or self.token, params):
+            yield from page.get("value", [])
+
+    def graph_batch(
+        self, batch_requests: list, token: dict = None, status_codes: list = None
+    ) -> list:
+        """Sends requests to the Graph API in JSON batches.
+
+        Requests are sent in batches of up to GRAPH_BATCH_SIZE. Requests that are
+        throttled or fail transiently within a batch are retried in a later batch,
+        using the same backoff as make_graph_request. Collections returned by GET
+        requests are followed to their last page.
+
+        Args:
+            batch_requests (list): The requests as dicts with the keys "method", "url"
+                (the full Graph URL) and optionally "body" (a dict).
+            token (dict, optional): The access token to use. Defaults to self.token.
+            status_codes (list, optional): If provided, a ProcessorError is raised if
+                any request returns a status code not in the list. Defaults to None.
+
+        Returns:
+            list: A dict with the keys "status", "headers" and "body" for each request,
+                in the same order as the requests.
+
+        Raises:
+            ProcessorError: If a batch fails, a batch response leaves out a request or a
+                request returns a status code not in status_codes.
+        """
+        token = token or self.token
+        max_attempts = int(self.env.get("GRAPH_MAX_ATTEMPTS") or GRAPH_MAX_ATTEMPTS)
+        results = [None] * len(batch_requests)
+
+        # A batch can only target one API version, group the requests by version
+        pending_by_version = {}
+        for index, batch_request in enumerate(batch_requests):
+            version, _, path = (
+                batch_request["url"].removeprefix(f"{GRAPH_URL}/").partition("/")
+            )
+            sub_request = {
+                "id": str(index),
+                "method": batch_request["method"],
+                "url": f"/{path}",
+            }
+            if batch_request.get("body") is not None:
+                sub_request["body"] = batch_request["body"]
+                sub_request["headers"] = {"Content-Type": "application/json"}
+            pending_by_version.setdefault(version, []).append(sub_request)
+
+        for version, pending in pending_by_version.items():
+            attempt = 1
+            while pending:
+                retry, delay = [], 0
+                for i in range(0, len(pending), GRAPH_BATCH_SIZE):
+                    chunk = {r["id"]: r for r in pending[i : i + GRAPH_BATCH_SIZE]}
+                    response = self.make_graph_request(
+                        "POST",
+                        f"{GRAPH_URL}/{version}/$batch",
+                        token,
+                        data=json.dumps({"requests": list(chunk.values())}),
+                        cost=len(chunk),
+                        idempotent=all(
+                            r["method"] in ("GET", "DELETE") for r in chunk.values()
+                        ),
+                    )
+                    if response.status_code != 200:
+                        raise ProcessorError(
+                            "Request failed with ",
+                            response.status_code,
+                            " - ",
+                            response.text,
+                        )
+
+                    responses = json.loads(response.text)["responses"]
+                    missing = set(chunk) - {item["id"] for item in responses}
+                    if missing:
+                        raise ProcessorError(
+                            "Graph batch response has no response for "
+                            + ", ".join(
+                                f"{chunk[i]['method']} {chunk[i]['url']}"
+                                for i in sorted(missing, key=int)
+                            )
+                        )
+
+                    for item in responses:
+                        headers = item.get("headers") or {}
+                        if item["status"] == 429:
+                            self.update_rate_limit(item["status"], headers)
+                        retry_status_codes = (
+                            RETRY_STATUS_CODES
+                            if chunk[item["id"]]["method"] in ("GET", "DELETE")
+                            else NOT_PROCESSED_STATUS_CODES
+                        )
+                        if (
+                            item["status"] in retry_status_codes
+                            and attempt < max_attempts
+                        ):
+                            retry.append(chunk[item["id"]])
+                            delay = max(delay, self.retry_delay(headers, attempt))
+                            continue
+                        results[int(item["id"])] = {
+                            "status": item["status"],
+                            "headers": headers,
+                            "body": item.get("body"),
+                        }
+
+                if retry:
+                    self.output(
+                        f"{len(retry)} batched Graph requests failed transiently, trying again after {delay:.1f} seconds"
+                    )
+                    self.sleep_within_deadline(delay, "retrying batched requests")
+                pending = retry
+                attempt += 1
+
+        for result in results:
+            body = result["body"]
+            # Follow collections returned by GET requests to their last page
+            if isinstance(body, dict) and body.get("@odata.nextLink"):
+                for page in self.iter_graph_pages(body.pop("@odata.nextLink"), token):
+                    body["value"].extend(page["value"])
+
+        if status_codes is not None:
+            failed = [
+                f"{batch_request['method']} {batch_request['url']} ({result['status']})"
+                for batch_request, result in zip(batch_requests, results, strict=True)
+                if result["status"] not in status_codes
+            ]
+            if failed:
+                raise ProcessorError(f"Batched requests failed: {', '.join(failed)}")
+
+        return results
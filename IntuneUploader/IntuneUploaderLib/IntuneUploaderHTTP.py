@@ -0,0 +1,763 @@
+#!/usr/local/autopkg/python
+# -*- coding: utf-8 -*-
+
+"""
+IntuneUploaderHTTP makes the HTTP requests of the processors to Graph and Azure Storage.
+"""
+
+import base64
+import hashlib
+import io
+import json
+import os
+import random
+import socket
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import requests
+import urllib3
+from autopkglib import ProcessorError
+from requests.adapters import HTTPAdapter
+
+from IntuneUploaderLib.IntuneUploaderRun import _token_credentials
+
+__all__ = ["HTTPMixin"]
+
+# Default size of the connection pool kept for each host
+HTTP_POOL_SIZE = 10
+# Default connect and read timeouts in seconds for HTTP requests
+HTTP_CONNECT_TIMEOUT = 10
+HTTP_READ_TIMEOUT = 120
+# Pooled HTTP sessions shared by all processors in a run, keyed by host
+_sessions = {}
+_sessions_lock = threading.Lock()
+# Status codes of Graph responses that are retried
+RETRY_STATUS_CODES = [412, 429, 502, 503, 504]
+# Status codes that mean Graph did not process the request, the only ones retried for
+# requests that are not idempotent
+NOT_PROCESSED_STATUS_CODES = [412, 429, 503]
+# Default maximum number of attempts and total seconds spent retrying a Graph request
+GRAPH_MAX_ATTEMPTS = 6
+GRAPH_MAX_RETRY_TIME = 300
+# Base and maximum backoff in seconds between retries
+RETRY_BACKOFF_BASE = 2
+RETRY_BACKOFF_MAX = 60
+# Default sustained Graph requests per second per tenant and the burst allowed above it
+GRAPH_RATE_LIMIT = 10
+GRAPH_RATE_BURST = 20
+# Lowest rate in requests per second the rate limiter slows down to when throttled
+GRAPH_RATE_MIN = 0.5
+# Name of the rate limiter database in the cache directory, shared by all processes
+RATE_LIMITER_FILE = "ratelimit.sqlite"
+# Rate limiter connections of this process with a lock each, keyed by cache directory
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+# Rates of the Graph rate limiter last seen by this process, keyed by bucket
+_rate_limiter_rates = {}
+# Share of failed calls among the last CIRCUIT_WINDOW calls of an endpoint class that
+# trips its circuit breaker, once at least CIRCUIT_MIN_CALLS calls were made
+CIRCUIT_ERROR_RATE = 0.5
+CIRCUIT_WINDOW = 20
+CIRCUIT_MIN_CALLS = 5
+# Seconds a tripped circuit breaker fails calls before letting a probe through
+CIRCUIT_COOLDOWN = 60
+# Circuit breakers of this run, keyed by tenant ID and endpoint class
+_circuits = {}
+_circuits_lock = threading.Lock()
+# Number of recent Graph GET latencies kept per endpoint class, how many are needed
+# before GETs are hedged and the latency quantile after which a duplicate is sent
+HEDGE_LATENCY_SAMPLES = 100
+HEDGE_MIN_SAMPLES = 20
+HEDGE_LATENCY_QUANTILE = 0.95
+# Recent Graph GET latencies of this run, keyed by endpoint class
+_latencies = {}
+_latencies_lock = threading.Lock()
+# Name of the socket of the optional local daemon in the cache directory
+DAEMON_SOCKET_FILE = "daemon.sock"
+
+
+class HTTPMixin:
+    """Makes HTTP requests to Graph and Azure Storage."""
+
+    def get_session(self, url: str) -> requests.Session:
+        """Gets the pooled HTTP session for the host of a URL.
+
+        Sessions are shared by all processors in a run so connections to Graph and
+        Azure Storage are kept alive and reused. The pool size can be set with the
+        HTTP_POOL_SIZE variable.
+
+        Args:
+            url (str): The URL the session will be used for.
+
+        Returns:
+            requests.Session: The session for the host.
+        """
+        host = urlparse(url).netloc
+        with _sessions_lock:
+            session = _sessions.get(host)
+            if session is None:
+                pool_size = int(self.env.get("HTTP_POOL_SIZE") or HTTP_POOL_SIZE)
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+                session = requests.Session()
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _sessions[host] = session
+
+        return session
+
+    def http_request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """Makes an HTTP request using the pooled session for the host.
+
+        The connect and read timeouts can be set with the HTTP_CONNECT_TIMEOUT and
+        HTTP_READ_TIMEOUT variables unless a timeout is passed. They are shortened to
+        the remaining runtime budget of the processor. Requests without a binary body are
+        sent through the local daemon if it is running, so its warm connections are used.
+        They are sent directly if the daemon fails to answer.
+
+        Args:
+            method (str): The HTTP method to use.
+            url (str): The URL to make the request to.
+            **kwargs: Additional arguments passed to requests.Session.request.
+
+        Returns:
+            requests.Response: The response from the request.
+        """
+        kwargs.setdefault(
+            "timeout",
+            (
+                float(self.env.get("HTTP_CONNECT_TIMEOUT") or HTTP_CONNECT_TIMEOUT),
+                float(self.env.get("HTTP_READ_TIMEOUT") or HTTP_READ_TIMEOUT),
+            ),
+        )
+        remaining = self.get_remaining_time()
+        if remaining is not None and isinstance(kwargs["timeout"], tuple):
+            kwargs["timeout"] = tuple(
+                min(timeout, max(remaining, 0.001)) for timeout in kwargs["timeout"]
+            )
+        if not isinstance(kwargs.get("data"), bytes) and set(kwargs) <= {
+            "headers",
+            "params",
+            "data",
+            "timeout",
+        }:
+            result = self.daemon_request(
+                {"op": "http_request", "method": method, "url": url, **kwargs},
+                timeout=sum(kwargs["timeout"])
+                if isinstance(kwargs["timeout"], tuple)
+                else kwargs["timeout"],
+            )
+            if result is not None:
+                # The daemon reports failures to connect apart, nothing was sent then
+                if result.get("error") == "ConnectError":
+                    raise requests.exceptions.ConnectTimeout(result["message"])
+                if result.get("error") == "Timeout":
+                    raise requests.exceptions.Timeout(result["message"])
+                if result.get("error"):
+                    raise requests.exceptions.ConnectionError(result["message"])
+                # The daemon sends the decoded content, so the headers describing its
+                # encoding on the wire are left out of the raw response
+                raw = urllib3.HTTPResponse(
+                    body=io.BytesIO(base64.b64decode(result["content"])),
+                    headers={
+                        name: value
+                        for name, value in result["headers"].items()
+                        if name.lower()
+                        not in (
+                            "content-encoding",
+                            "content-length",
+                            "transfer-encoding",
+                        )
+                    },
+                    status=result["status_code"],
+                    preload_content=False,
+                )
+                response = HTTPAdapter().build_response(
+                    requests.Request(
+                        method, url, params=kwargs.get("params")
+                    ).prepare(),
+                    raw,
+                )
+                response.headers = requests.structures.CaseInsensitiveDict(
+                    result["headers"]
+                )
+                response.encoding = result["encoding"]
+                return response
+
+        return self.get_session(url).request(method, url, **kwargs)
+
+    def retry_delay(self, headers: dict, attempt: int) -> float:
+        """Gets the number of seconds to wait before retrying a request.
+
+        The Retry-After header is honored if present, otherwise the delay is an
+        exponential backoff with jitter.
+
+        Args:
+            headers (dict): The headers of the failed response, None if no response was received.
+            attempt (int): The number of the failed attempt, starting at 1.
+
+        Returns:
+            float: The number of seconds to wait.
+        """
+        retry_after = headers.get("Retry-After") if headers else None
+        if retry_after:
+            try:
+                return max(float(retry_after), 0)
+            except ValueError:
+                try:
+                    retry_at = parsedate_to_datetime(retry_after)
+                    return max(
+                        (retry_at - datetime.now(timezone.utc)).total_seconds(), 0
+                    )
+                except (TypeError, ValueError):
+                    pass
+
+        backoff = min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** (attempt - 1))
+        return backoff / 2 + random.uniform(0, backoff / 2)
+
+    def is_connect_error(self, error: Exception) -> bool:
+        """Checks whether a request failed before anything was sent.
+
+        Args:
+            error (Exception): The error raised by the request.
+
+        Returns:
+            bool: True if the connection could not be established.
+        """
+        if isinstance(error, requests.exceptions.ConnectTimeout):
+            return True
+        reason = getattr(error.args[0], "reason", None) if error.args else None
+        return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+    def make_graph_request(
+        self,
+        method: str,
+        endpoint: str,
+        token: dict,
+        q_param=None,
+        data=None,
+        cost: int = 1,
+        idempotent: bool = None,
+    ) -> requests.Response:
+        """Makes a request to the Graph API, retrying transient failures.
+
+        Throttled (429), precondition failed (412) and server unavailable (502, 503, 504)
+        responses as well as connection errors are retried with exponential backoff and
+        jitter, honoring Retry-After. Requests that are not idempotent, like POST and
+        PATCH, are only retried if Graph did not process them (412, 429, 503) or the
+        connection could not be established, so a retry can not create an app or
+        content version twice. The query parameters and body are sent on every
+        attempt. The number of attempts and the total time spent retrying can be limited
+        with the GRAPH_MAX_ATTEMPTS and GRAPH_MAX_RETRY_TIME variables. The access token
+        is refreshed before it expires and the request is replayed once if it is rejected.
+        Every attempt waits for the rate limiter shared by all processes on the host. The
+        call fails fast while the circuit breaker of the endpoint class is open, it is
+        checked once before the first attempt and the outcome of the call is recorded
+        once after its retries. GETs can be hedged, see send_graph_request.
+
+        Args:
+            method (str): The HTTP method to use.
+            endpoint (str): The endpoint to make the request to.
+            token (dict): The access token to use for authenticating the request.
+            q_param (dict, optional): The query parameters to use for the request. Defaults to None.
+            data (str, optional): The body to send with the request. Defaults to None.
+            cost (int, optional): The number of Graph requests sent at once, for example
+                in a JSON batch. Defaults to 1.
+            idempotent (bool, optional): Whether the request can safely be sent twice.
+                Defaults to True for all methods but POST and PATCH.
+
+        Returns:
+            requests.Response: The response of the last attempt.
+
+        Raises:
+            ProcessorError: If no response could be received or the circuit breaker is open.
+        """
+        if idempotent is None:
+            idempotent = method not in ("POST", "PATCH")
+        circuit = self.get_endpoint_class(endpoint)
+        max_attempts = int(self.env.get("GRAPH_MAX_ATTEMPTS") or GRAPH_MAX_ATTEMPTS)
+        max_retry_time = float(
+            self.env.get("GRAPH_MAX_RETRY_TIME") or GRAPH_MAX_RETRY_TIME
+        )
+        start_time = time.monotonic()
+        attempt = 1
+        token_refreshed = False
+        self.check_circuit(circuit)
+
+        while True:
+            # Refresh the token before it expires so long running processors keep working
+            self.refresh_accesstoken(token)
+            headers = {
+                "Content-Type": "application/json",
+                "Authorization": "Bearer {0}".format(token["access_token"]),
+            }
+            self.check_deadline(f"requesting {circuit}")
+            self.acquire_rate_limit(cost)
+            self.count_metric("graph_requests")
+            try:
+                response = self.send_graph_request(
+                    method,
+                    endpoint,
+                    circuit,
+                    headers=headers,
+                    params=q_param or None,
+                    data=data,
+                )
+                error = None
+                self.update_rate_limit(response.status_code, response.headers)
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+            ) as e:
+                response = None
+                error = e
+
+            # Replay the request once with a new token if the token was rejected
+            if (
+                response is not None
+                and response.status_code == 401
+                and not token_refreshed
+                and token.get("cache_key") in _token_credentials
+            ):
+                self.output("Access token was rejected, refreshing it and trying again")
+                self.refresh_accesstoken(token, force=True)
+                token_refreshed = True
+                continue
+
+            if response is None:
+                retry = idempotent or self.is_connect_error(error)
+            elif idempotent:
+                retry = response.status_code in RETRY_STATUS_CODES
+            else:
+                retry = response.status_code in NOT_PROCESSED_STATUS_CODES
+            if response is not None and not retry:
+                self.record_circuit(circuit, response.status_code < 500)
+                return response
+
+            delay = self.retry_delay(
+                response.headers if response is not None else None, attempt
+            )
+            if (
+                not retry
+                or attempt >= max_attempts
+                or time.monotonic() - start_time + delay > max_retry_time
+            ):
+                self.record_circuit(
+                    circuit, response is not None and response.status_code < 500
+                )
+                if response is None:
+                    raise ProcessorError(f"Request to {endpoint} failed: {error}")
+                return response
+
+            if response is None:
+                reason = f"Request to Graph failed ({error.__class__.__name__})"
+            elif response.status_code == 429:
+                reason = "Hit Graph throttling"
+            elif response.status_code == 412:
+                reason = "Precondition failed"
+            else:
+                reason = f"Ran into issues with Graph request ({response.status_code})"
+            self.output(
+                f"{reason}, trying again after {delay:.1f} seconds (attempt {attempt} of {max_attempts})"
+            )
+            self.sleep_within_deadline(delay, f"retrying {circuit}")
+            attempt += 1
+
+    @contextmanager
+    def open_rate_limiter(self):
+        """Opens the Graph rate limiter database in the cache directory.
+
+        The connection is opened once per process and shared by its threads, one at a
+        time. A transaction left open by an error is rolled back.
+
+        Yields:
+            sqlite3.Connection: A connection to the rate limiter, without implicit transactions.
+        """
+        cache_key = self.env.get("CACHE_DIR")
+        with _rate_limiters_lock:
+            if cache_key not in _rate_limiters:
+                conn = sqlite3.connect(
+                    os.path.join(self.get_cache_dir(), RATE_LIMITER_FILE),
+                    timeout=60,
+                    isolation_level=None,
+                    check_same_thread=False,
+                )
+                conn.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS buckets (
+                        key TEXT PRIMARY KEY,
+                        tokens REAL,
+                        rate REAL,
+                        updated_at REAL,
+                        blocked_until REAL
+                    )
+                    """
+                )
+                _rate_limiters[cache_key] = (conn, threading.Lock())
+            conn, conn_lock = _rate_limiters[cache_key]
+
+        with conn_lock:
+            try:
+                yield conn
+            finally:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+
+    def get_rate_limits(self) -> tuple:
+        """Gets the configured Graph rate limit and burst.
+
+        Returns:
+            tuple: The requests per second from the GRAPH_RATE_LIMIT variable, 0 if rate
+                limiting is disabled, and the burst from the GRAPH_RATE_BURST variable.
+        """
+        return (
+            float(self.env.get("GRAPH_RATE_LIMIT", GRAPH_RATE_LIMIT)),
+            float(self.env.get("GRAPH_RATE_BURST", GRAPH_RATE_BURST)),
+        )
+
+    def acquire_rate_limit(self, cost: int = 1) -> None:
+        """Waits until a Graph request may be sent to the tenant.
+
+        The rate limiter is a token bucket per tenant shared by all processes on the
+        host through a SQLite database. Its rate starts at GRAPH_RATE_LIMIT and is
+        adapted by update_rate_limit to the throttling Graph reports.
+
+        Args:
+            cost (int, optional): The number of Graph requests sent at once, for example
+                in a JSON batch. Defaults to 1.
+        """
+        limit, burst = self.get_rate_limits()
+        if not limit:
+            return
+        burst = max(burst, cost)
+        key = hashlib.sha256(getattr(self, "TENANT_ID", "").encode()).hexdigest()
+
+        while True:
+            with self.open_rate_limiter() as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                row = conn.execute(
+                    "SELECT tokens, rate, updated_at, blocked_until FROM buckets WHERE key = ?",
+                    (key,),
+                ).fetchone()
+                now = time.time()
+                if row is None:
+                    tokens, rate, blocked_until = burst, limit, 0
+                else:
+                    tokens, rate, updated_at, blocked_until = row
+                    rate = min(rate, limit)
+                    tokens = min(burst, tokens + max(now - updated_at, 0) * rate)
+
+                if now < blocked_until:
+                    delay = blocked_until - now
+                elif tokens >= cost:
+                    tokens -= cost
+                    delay = 0
+                else:
+                    delay = (cost - tokens) / rate
+                conn.execute(
+                    "INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?, ?)",
+                    (key, tokens, rate, now, blocked_until),
+                )
+                conn.execute("COMMIT")
+                _rate_limiter_rates[key] = rate
+
+            if not delay:
+                return
+            self.sleep_within_deadline(delay, "waiting for the Graph rate limiter")
+
+    def update_rate_limit(self, status_code: int, headers: dict) -> None:
+        """Adapts the rate of the Graph rate limiter to a response.
+
+        Throttled responses halve the rate and pause all requests to the tenant for
+        the Retry-After time. When x-ms-throttle-limit-percentage reports that most of
+        the limit is used, the rate is lowered before Graph starts throttling. Otherwise
+        the rate recovers slowly towards GRAPH_RATE_LIMIT. Responses without throttling
+        leave the database alone while the rate last seen is at the limit.
+
+        Args:
+            status_code (int): The status code of the response.
+            headers (dict): The headers of the response.
+        """
+        limit, _ = self.get_rate_limits()
+        if not limit:
+            return
+        key = hashlib.sha256(getattr(self, "TENANT_ID", "").encode()).hexdigest()
+
+        throttled = status_code in (429, 503)
+        try:
+            limit_percentage = float(headers.get("x-ms-throttle-limit-percentage") or 0)
+        except ValueError:
+            limit_percentage = 0
+
+        if (
+            not throttled
+            and limit_percentage < 0.8
+            and _rate_limiter_rates.get(key, limit) >= limit
+        ):
+            return
+
+        with self.open_rate_limiter() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if throttled:
+                blocked_until = time.time() + (
+                    self.retry_delay(headers, 1) if headers.get("Retry-After") else 0
+                )
+                conn.execute(
+                    "UPDATE buckets SET rate = max(rate / 2, ?), blocked_until = max(blocked_until, ?) WHERE key = ?",
+                    (GRAPH_RATE_MIN, blocked_until, key),
+                )
+                self.output(
+                    f"Graph is throttling requests ({headers.get('x-ms-throttle-scope') or status_code}), slowing down",
+                    verbose_level=2,
+                )
+            elif limit_percentage >= 0.8:
+                conn.execute(
+                    "UPDATE buckets SET rate = max(rate * 0.75, ?) WHERE key = ?",
+                    (GRAPH_RATE_MIN, key),
+                )
+            else:
+                conn.execute(
+                    "UPDATE buckets SET rate = min(rate + ?, ?) WHERE key = ?",
+                    (limit / 20, limit, key),
+                )
+            row = conn.execute(
+                "SELECT rate FROM buckets WHERE key = ?", (key,)
+            ).fetchone()
+            conn.execute("COMMIT")
+            if row is not None:
+                _rate_limiter_rates[key] = row[0]
+
+    def get_endpoint_class(self, endpoint: str) -> str:
+        """Gets the endpoint class a Graph URL belongs to for the circuit breakers.
+
+        Args:
+            endpoint (str): The Graph URL.
+
+        Returns:
+            str: The resource path of the URL up to the first ID, for example
+                deviceAppManagement/mobileApps.
+        """
+        segments = []
+        for segment in urlparse(endpoint).path.strip("/").split("/"):
+            if segment in ("beta", "v1.0"):
+                continue
+            if len(segments) == 2 or any(char.isdigit() for char in segment):
+                break
+            segments.append(segment)
+        return "/".join(segments)
+
+    def check_circuit(self, name: str) -> None:
+        """Fails fast if the circuit breaker of an endpoint class is open.
+
+        A circuit breaker opens when too many calls of its endpoint class failed in this
+        run. After CIRCUIT_COOLDOWN seconds a single call is let through as a probe, the
+        circuit breaker closes again once a probe succeeds.
+
+        Args:
+            name (str): The endpoint class.
+
+        Raises:
+            ProcessorError: If the circuit breaker is open.
+        """
+        cooldown = float(self.env.get("CIRCUIT_COOLDOWN") or CIRCUIT_COOLDOWN)
+        key = (getattr(self, "TENANT_ID", ""), name)
+        with _circuits_lock:
+            circuit = _circuits.get(key)
+            if not circuit or circuit["opened_at"] is None:
+                return
+            now = time.monotonic()
+            # Let one call through as a probe once the cool-down has passed
+            if now - circuit["opened_at"] >= cooldown and (
+                circuit["probe_at"] is None or now - circuit["probe_at"] >= cooldown
+            ):
+                circuit["probe_at"] = now
+                self.output(
+                    f"Probing {name} after the circuit breaker cool-down",
+                    verbose_level=2,
+                )
+                return
+            remaining = max(cooldown - (now - circuit["opened_at"]), 0)
+
+        raise ProcessorError(
+            f"Circuit breaker for {name} is open after repeated Graph failures, not "
+            f"sending the request. It will be probed again in {remaining:.0f} seconds."
+        )
+
+    def record_circuit(self, name: str, success: bool) -> None:
+        """Records the outcome of a call for the circuit breaker of an endpoint class.
+
+        Args:
+            name (str): The endpoint class.
+            success (bool): Whether the call succeeded.
+        """
+        error_rate = float(self.env.get("CIRCUIT_ERROR_RATE") or CIRCUIT_ERROR_RATE)
+        key = (getattr(self, "TENANT_ID", ""), name)
+        with _circuits_lock:
+            circuit = _circuits.setdefault(
+                key,
+                {
+                    "results": deque(maxlen=CIRCUIT_WINDOW),
+                    "opened_at": None,
+                    "probe_at": None,
+                },
+            )
+
+            if circuit["opened_at"] is not None:
+                if success:
+                    self.output(
+                        f"Graph recovered for {name}, closing the circuit breaker"
+                    )
+                    circuit["results"].clear()
+                    circuit["opened_at"] = circuit["probe_at"] = None
+                elif circuit["probe_at"] is not None:
+                    circuit["opened_at"] = time.monotonic()
+                    circuit["probe_at"] = None
+                return
+
+            circuit["results"].append(success)
+            failures = circuit["results"].count(False)
+            if (
+                len(circuit["results"]) >= CIRCUIT_MIN_CALLS
+                and failures / len(circuit["results"]) >= error_rate
+            ):
+                self.output(
+                    f"{failures} of the last {len(circuit['results'])} calls to {name} "
+                    "failed, opening the circuit breaker"
+                )
+                self.count_metric("circuit_breaker_trips")
+                circuit["opened_at"] = time.monotonic()
+
+    def get_hedge_delay(self, name: str):
+        """Gets the seconds after which a Graph GET of an endpoint class is hedged.
+
+        Args:
+            name (str): The endpoint class.
+
+        Returns:
+            float: The HEDGE_LATENCY_QUANTILE of the recent latencies of the endpoint
+                class, None if hedging is disabled or too few latencies were recorded.
+        """
+        if str(self.env.get("GRAPH_HEDGE_REQUESTS", "")).lower() not in ("1", "true"):
+            return None
+        with _latencies_lock:
+            latencies = sorted(_latencies.get(name, ()))
+        if len(latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        return latencies[int(len(latencies) * HEDGE_LATENCY_QUANTILE)]
+
+    def record_latency(self, name: str, latency: float) -> None:
+        """Records the latency of a Graph GET of an endpoint class.
+
+        Args:
+            name (str): The endpoint class.
+            latency (float): The seconds until the response arrived.
+        """
+        with _latencies_lock:
+            _latencies.setdefault(name, deque(maxlen=HEDGE_LATENCY_SAMPLES)).append(
+                latency
+            )
+
+    def send_graph_request(
+        self, method: str, endpoint: str, circuit: str, **kwargs
+    ) -> requests.Response:
+        """Sends a single Graph request, hedging GETs that take unusually long.
+
+        If hedging is enabled with the GRAPH_HEDGE_REQUESTS variable and a GET has not
+        been answered after the usual latency of its endpoint class, a duplicate request
+        is sent and whichever response arrives first is used. Only GETs are hedged as
+        they can safely be sent twice.
+
+        Args:
+            method (str): The HTTP method to use.
+            endpoint (str): The URL to make the request to.
+            circuit (str): The endpoint class of the URL.
+            **kwargs: Additional arguments passed to http_request.
+
+        Returns:
+            requests.Response: The first response received.
+        """
+        if method != "GET":
+            return self.http_request(method, endpoint, **kwargs)
+
+        def _send():
+            started_at = time.monotonic()
+            response = self.http_request(method, endpoint, **kwargs)
+            self.record_latency(circuit, time.monotonic() - started_at)
+            return response
+
+        hedge_delay = self.get_hedge_delay(circuit)
+        if hedge_delay is None:
+            return _send()
+
+        # The executor is not waited for, the slower request finishes in the background
+        executor = ThreadPoolExecutor(max_workers=2)
+        try:
+            pending = {executor.submit(_send)}
+            done, _ = wait(pending, timeout=hedge_delay)
+            if not done:
+                self.output(
+                    f"No response from {circuit} after {hedge_delay:.2f} seconds, sending a hedged request",
+                    verbose_level=2,
+                )
+                self.acquire_rate_limit()
+                self.count_metric("graph_requests")
+                self.count_metric("hedged_requests")
+                pending.add(executor.submit(_send))
+
+            # Use the first response, only failing if every request failed
+            while True:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is None:
+                        return future.result()
+                if not pending:
+                    # Every request failed, raise the error of the last one
+                    return done.pop().result()
+        finally:
+            executor.shutdown(wait=False)
+
+    def daemon_request(self, request: dict, timeout=None):
+        """Sends a request to the local daemon if it is running.
+
+        The daemon, IntuneUploaderDaemon.py in IntuneUploaderLib, listens on
+        DAEMON_SOCKET_FILE in the cache directory and keeps pooled sessions and tokens
+        warm between processes.
+
+        Args:
+            request (dict): The operation and its arguments.
+            timeout (float, optional): The seconds to wait for the operation, on top
+                of a short margin. Defaults to None.
+
+        Returns:
+            dict: The response of the daemon, None if it is not running or failed to
+                answer, in which case the caller does the operation itself.
+        """
+        socket_path = os.path.join(self.get_cache_dir(), DAEMON_SOCKET_FILE)
+        if not os.path.exists(socket_path):
+            return None
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout((timeout or 0) + 5)
+            try:
+                sock.connect(socket_path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # The socket was left behind by a daemon that is no longer running
+                return None
+            try:
+                sock.sendall(json.dumps(request).encode() + b"\n")
+                with sock.makefile("rb") as f:
+                    # An empty line means the daemon stopped while handling the request
+                    return json.loads(f.readline())
+            except (OSError, ValueError) as e:
+                self.output(
+                    f"The local daemon failed to answer ({e}), not using it",
+                    verbose_level=2,
+                )
+                return None
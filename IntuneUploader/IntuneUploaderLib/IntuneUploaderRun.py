@@ -0,0 +1,403 @@
+#!/usr/local/autopkg/python
+# -*- coding: utf-8 -*-
+
+"""
+IntuneUploaderRun keeps the state of processor runs, such as their access tokens and runtime
+budget, runs their phases and records their metrics.
+"""
+
+import base64
+import copy
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+
+from autopkglib import ProcessorError
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives.hashes import SHA256
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+__all__ = ["RunMixin"]
+
+# Seconds before expiry at which a cached access token is refreshed
+TOKEN_REFRESH_MARGIN = 300
+# Access tokens shared by all processors in a run, keyed by tenant and client ID
+_tokens = {}
+_tokens_lock = threading.Lock()
+# Lock per token, so the tokens of different tenants are obtained concurrently
+_token_locks = {}
+_token_credentials = {}
+
+
+class RunMixin:
+    """Keeps the tokens and budget of a run, runs its phases and records its metrics."""
+
+    def obtain_accesstoken(
+        self,
+        client_id: str,
+        client_secret: str,
+        tenant_id: str,
+        force_refresh: bool = False,
+    ) -> dict:
+        """This function obtains an access token from the Microsoft Graph API.
+
+        Tokens are cached per tenant and client ID in memory and on disk, so processors
+        and recipes in a run share them. A cached token is reused until TOKEN_REFRESH_MARGIN
+        seconds before it expires. On disk the token is encrypted with a key derived from
+        the client secret and the cache is locked while it is read and refreshed. Each
+        token has its own lock, so tokens of different tenants are obtained concurrently.
+        If the local daemon is running, it also holds the token so later processes skip
+        the disk cache.
+
+        Args:
+            client_id (str): The client ID to use for authenticating the request.
+            client_secret (str): The client secret to use for authenticating the request.
+            tenant_id (str): The tenant ID to use for authenticating the request.
+            force_refresh (bool, optional): Whether to request a new token even if a cached
+                token is still valid. Defaults to False.
+
+        Returns:
+            dict: The response from the request as a dictionary.
+        """
+        cache_key = hashlib.sha256(f"{tenant_id}:{client_id}".encode()).hexdigest()
+        # Tokens in memory are only shared with callers using the same secret
+        memory_key = hashlib.sha256(f"{cache_key}:{client_secret}".encode()).hexdigest()
+
+        def _is_valid(token):
+            return (
+                not force_refresh
+                and token is not None
+                and token.get("expires_at", 0) - TOKEN_REFRESH_MARGIN > time.time()
+            )
+
+        with _tokens_lock:
+            token_lock = _token_locks.setdefault(memory_key, threading.Lock())
+
+        with token_lock:
+            token = _tokens.get(memory_key)
+            if _is_valid(token):
+                return token
+
+            # A running daemon holds the tokens of earlier processes in memory
+            token = (self.daemon_request({"op": "token", "key": memory_key}) or {}).get(
+                "token"
+            )
+            if not _is_valid(token):
+                cache_file = os.path.join(self.get_cache_dir(), f"token_{cache_key}")
+                fernet = Fernet(
+                    base64.urlsafe_b64encode(
+                        HKDF(
+                            algorithm=SHA256(),
+                            length=32,
+                            salt=cache_key.encode(),
+                            info=b"IntuneUploader token cache",
+                        ).derive(client_secret.encode())
+                    )
+                )
+
+                with open(f"{cache_file}.lock", "a", encoding="utf-8") as lock_file:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                    try:
+                        # Another process may already have refreshed the token
+                        try:
+                            with open(cache_file, "rb") as f:
+                                token = json.loads(fernet.decrypt(f.read()))
+                        except (OSError, ValueError, InvalidToken):
+                            token = None
+
+                        if not _is_valid(token):
+                            token = self.request_accesstoken(
+                                client_id, client_secret, tenant_id
+                            )
+                            token["expires_at"] = time.time() + int(
+                                token.get("expires_in", 0)
+                            )
+                            fd = os.open(
+                                f"{cache_file}.tmp",
+                                os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                                0o600,
+                            )
+                            with os.fdopen(fd, "wb") as f:
+                                f.write(fernet.encrypt(json.dumps(token).encode()))
+                            os.replace(f"{cache_file}.tmp", cache_file)
+                    finally:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+                self.daemon_request({"op": "token", "key": memory_key, "token": token})
+
+            # Remember how to refresh the token, the credentials are only kept in memory
+            token["cache_key"] = memory_key
+            _token_credentials[memory_key] = (client_id, client_secret, tenant_id)
+            _tokens[memory_key] = token
+
+        return token
+
+    def request_accesstoken(
+        self, client_id: str, client_secret: str, tenant_id: str
+    ) -> dict:
+        """Requests a new access token from the Microsoft identity platform.
+
+        Args:
+            client_id (str): The client ID to use for authenticating the request.
+            client_secret (str): The client secret to use for authenticating the request.
+            tenant_id (str): The tenant ID to use for authenticating the request.
+
+        Returns:
+            dict: The response from the request as a dictionary.
+        """
+
+        url = f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token"
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        data = {
+            "grant_type": "client_credentials",
+            "client_id": client_id,
+            "client_secret": client_secret,
+            "scope": "https://graph.microsoft.com/.default",
+        }
+
+        response = self.http_request("POST", url, headers=headers, data=data)
+
+        if response.status_code != 200:
+            raise ProcessorError(
+                f"Failed to obtain access token. Status code: {response.status_code}"
+            )
+        response = json.loads(response.text)
+        return response
+
+    def refresh_accesstoken(self, token: dict, force: bool = False) -> None:
+        """Refreshes an access token in place if it is about to expire.
+
+        The token is updated in place so every processor holding it uses the new
+        token. Tokens not obtained with obtain_accesstoken are left untouched.
+
+        Args:
+            token (dict): The access token to refresh.
+            force (bool, optional): Whether to refresh the token even if it is not
+                about to expire, for example after it was rejected. Defaults to False.
+        """
+        credentials = _token_credentials.get(token.get("cache_key"))
+        if credentials is None:
+            return
+        if not force and token["expires_at"] - TOKEN_REFRESH_MARGIN > time.time():
+            return
+
+        new_token = self.obtain_accesstoken(*credentials, force_refresh=force)
+        if new_token is not token:
+            token.update(new_token)
+
+    def run_phases(self, phases: dict) -> tuple:
+        """Runs phases concurrently, each as soon as the phases it depends on finished.
+
+        If a phase fails, no further phases are started and phases_failed is set so
+        long running phases can stop early. The phases already running are allowed to
+        finish so they can clean up, then the first error is raised.
+        The time spent in each phase is recorded in the metrics of the run.
+
+        Args:
+            phases (dict): A tuple of the function to run and the names of the phases it
+                depends on, by phase name.
+
+        Returns:
+            tuple: The wall-clock seconds of each phase and the seconds saved by running
+                phases concurrently instead of one after the other.
+        """
+
+        def _run(name, func):
+            started_at = time.monotonic()
+            with self.phase(name):
+                func()
+            return time.monotonic() - started_at
+
+        started_at = time.monotonic()
+        pending = dict(phases)
+        running = {}
+        durations = {}
+        errors = []
+        self.phases_failed = threading.Event()
+        with ThreadPoolExecutor(max_workers=max(len(phases), 1)) as executor:
+            while pending or running:
+                for name, (func, dependencies) in list(pending.items()):
+                    if not errors and all(dep in durations for dep in dependencies):
+                        del pending[name]
+                        running[executor.submit(_run, name, func)] = name
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        durations[name] = future.result()
+                    except (ProcessorError, OSError, KeyError, ValueError) as e:
+                        errors.append(e)
+                        self.phases_failed.set()
+
+        if errors:
+            raise errors[0]
+        if pending:
+            raise ProcessorError(
+                f"Phases {', '.join(pending)} depend on phases that do not exist"
+            )
+
+        saved = max(sum(durations.values()) - (time.monotonic() - started_at), 0)
+        return durations, saved
+
+    def process(self):
+        """Runs the processor and records its metrics.
+
+        If the processor has a <processor name>_metrics output variable, the metrics
+        of the run are set in it.
+        """
+        self.init_metrics()
+        self.start_deadline()
+        env = super().process()
+        metrics_variable = f"{self.__class__.__name__.lower()}_metrics"
+        if metrics_variable in self.output_variables:
+            self.env[metrics_variable] = self.get_metrics()
+        return env
+
+    def init_metrics(self) -> None:
+        """Starts recording the metrics of a run."""
+        self.metrics = {
+            "phases": {},
+            "upload_states": {},
+            "bytes_read": 0,
+            "bytes_encrypted": 0,
+            "bytes_uploaded": 0,
+            "graph_requests": 0,
+            "circuit_breaker_trips": 0,
+            "hedged_requests": 0,
+        }
+        self.metrics_lock = threading.Lock()
+
+    def count_metric(self, name: str, value: int = 1) -> None:
+        """Adds to a counter in the metrics of the run.
+
+        Args:
+            name (str): The name of the counter.
+            value (int, optional): The value to add. Defaults to 1.
+        """
+        if getattr(self, "metrics", None) is None:
+            return
+        with self.metrics_lock:
+            self.metrics[name] += value
+
+    @contextmanager
+    def phase(self, name: str):
+        """Records the wall-clock and CPU seconds spent in a phase of the run.
+
+        Time spent in a phase more than once, for example once per tenant, is summed.
+        CPU time is that of the process, so it includes phases running at the same time.
+
+        Args:
+            name (str): The name of the phase.
+        """
+        started_at = time.monotonic()
+        cpu_started_at = time.process_time()
+        try:
+            yield
+        finally:
+            if getattr(self, "metrics", None) is not None:
+                with self.metrics_lock:
+                    phase = self.metrics["phases"].setdefault(
+                        name, {"wall_time": 0, "cpu_time": 0}
+                    )
+                    phase["wall_time"] += time.monotonic() - started_at
+                    phase["cpu_time"] += time.process_time() - cpu_started_at
+
+    def get_metrics(self) -> dict:
+        """Gets the metrics of the run with times rounded to milliseconds.
+
+        Returns:
+            dict: The wall-clock and CPU seconds of each phase, the seconds spent in
+                each upload state, the bytes read, encrypted and uploaded, the number of
+                Graph requests, of circuit breaker trips and of hedged requests.
+        """
+        with self.metrics_lock:
+            metrics = copy.deepcopy(self.metrics)
+        for phase in metrics["phases"].values():
+            phase["wall_time"] = round(phase["wall_time"], 3)
+            phase["cpu_time"] = round(phase["cpu_time"], 3)
+        for state, seconds in metrics["upload_states"].items():
+            metrics["upload_states"][state] = round(seconds, 3)
+        return metrics
+
+    def start_deadline(self) -> None:
+        """Starts the runtime budget of a processor with a max_runtime_seconds input.
+
+        Retries, polling and block uploads draw from the remaining budget and the
+        processor fails once it is spent.
+        """
+        max_runtime = (
+            self.env.get("max_runtime_seconds")
+            if "max_runtime_seconds" in self.input_variables
+            else None
+        )
+        self.max_runtime = float(max_runtime) if max_runtime else None
+        self.deadline = (
+            time.monotonic() + self.max_runtime if self.max_runtime else None
+        )
+
+    def get_remaining_time(self):
+        """Gets the seconds left of the runtime budget.
+
+        Returns:
+            float: The remaining seconds, None if the processor has no budget.
+        """
+        if getattr(self, "deadline", None) is None:
+            return None
+        return self.deadline - time.monotonic()
+
+    def deadline_exceeded(self) -> bool:
+        """Checks whether the runtime budget is spent.
+
+        Returns:
+            bool: True if the processor has a budget and it is spent.
+        """
+        remaining = self.get_remaining_time()
+        return remaining is not None and remaining <= 0
+
+    def check_deadline(self, description: str, delay: float = 0) -> None:
+        """Fails if the runtime budget does not last for a delay.
+
+        Args:
+            description (str): What is being done, used in the error.
+            delay (float, optional): The seconds that need to be left. Defaults to 0.
+
+        Raises:
+            ProcessorError: If the runtime budget is spent or would be by the delay.
+        """
+        remaining = self.get_remaining_time()
+        if remaining is not None and remaining <= delay:
+            # The budget counts as spent so callers know to clean up
+            self.deadline = time.monotonic()
+            raise ProcessorError(
+                f"Ran out of the max_runtime_seconds budget of {self.max_runtime:.0f} "
+                f"seconds while {description}"
+            )
+
+    def sleep_within_deadline(self, delay: float, description: str) -> None:
+        """Sleeps unless the runtime budget would be spent before waking up.
+
+        Args:
+            delay (float): The seconds to sleep.
+            description (str): What is being waited for, used in the error.
+
+        Raises:
+            ProcessorError: If the runtime budget does not last for the delay.
+        """
+        self.check_deadline(description, delay)
+        time.sleep(delay)
+
+    @contextmanager
+    def ignore_deadline(self):
+        """Lets cleanup requests run after the runtime budget is spent."""
+        deadline, self.deadline = getattr(self, "deadline", None), None
+        try:
+            yield
+        finally:
+            self.deadline = deadline
@@ -47,7 +47,10 @@ class IntuneVTAppDeleter(IntuneUploaderBase):
     output_variables = {
         "intunevtappdeleter_summary_result": {
             "description": "Description of interesting results."
-        }
+        },
+        "intunevtappdeleter_metrics": {
+            "description": "The wall-clock and CPU seconds of each phase and the number of Graph requests of the run."
+        },
     }
 
     def main(self):
@@ -76,13 +79,19 @@ class IntuneVTAppDeleter(IntuneUploaderBase):
             positives = int(positives)
 
         # Get access token
-        self.token = self.obtain_accesstoken(
-            self.CLIENT_ID, self.CLIENT_SECRET, self.TENANT_ID
-        )
+        with self.phase("auth"):
+            self.token = self.obtain_accesstoken(
+                self.CLIENT_ID, self.CLIENT_SECRET, self.TENANT_ID
+            )
 
-        def _get_app():
+        def _get_app(refresh=False):
             # Get macthing apps
-            app = self.get_matching_apps(app_name)
+            with self.phase("lookup"):
+                app = self.get_matching_apps(
+                    app_name,
+                    refresh,
+                    fields=["id", "primaryBundleVersion", "buildNumber", "fileName"],
+                )
             app = list(
                 map(
                     lambda item: (
@@ -104,6 +113,7 @@ class IntuneVTAppDeleter(IntuneUploaderBase):
 
             return app[0] if len(app) > 0 else None
 
+        # Get the app from the local app inventory
         app = _get_app()
 
         retry_count = 0
@@ -111,8 +121,8 @@ class IntuneVTAppDeleter(IntuneUploaderBase):
             self.output("No matching app found. Retrying in 5 seconds...")
             time.sleep(5)
             retry_count += 1
-            # Retry getting the app
-            app = _get_app()
+            # Retry getting the app from Intune
+            app = _get_app(refresh=True)
 
         if not app:
             self.output(
@@ -134,10 +144,21 @@ class IntuneVTAppDeleter(IntuneUploaderBase):
             self.output(
                 f"VirusTotal positives is greater than {positives}. Deleting app."
             )
-            if not test_mode:
-                self.makeapirequestDelete(
-                    self.BASE_ENDPOINT + "/" + app["id"], self.token
-                )
+            # The app is deleted based on it, so confirm it with Intune first unless a
+            # retry just got it from Intune
+            if not test_mode and self.get_app_inventory_ttl() and not retry_count:
+                app = _get_app(refresh=True)
+                if not app:
+                    deleted = False
+                    self.output(
+                        f"No matching app found in Intune for {app_name} and version {version}. Skipping deletion."
+                    )
+            if app and not test_mode:
+                with self.phase("delete"):
+                    self.makeapirequestDelete(
+                        self.BASE_ENDPOINT + "/" + app["id"], self.token
+                    )
+                    self.remove_from_app_inventory([app["id"]])
         else:
             self.output(
                 f"VirusTotal positives is less than {positives}. Not deleting app {app_name} {version}."